@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import threading
+
+import paho.mqtt.client as mqtt
+
+from MQTTClient import MQTTClient
+
+
+class AsyncMQTTClient(MQTTClient):
+    """MQTT bridge driving paho from the asyncio event loop.
+
+    The paho socket is registered with the loop, so the client only wakes up
+    when the broker sends data, a publish is pending or keepalive is due.
+    Message handling and publishing are inherited from MQTTClient.
+    """
+
+    def __init__(self, messageQ, commandQ, config, metricsQ=None):
+        MQTTClient.__init__(self, messageQ, commandQ, config, metricsQ)
+        self.logger = logging.getLogger('Max!-MQTT.AsyncMQTTClient')
+        self.loop = None
+        self.loop_thread = None
+        self._misc = None
+        # descriptor of the current socket, still valid for removal after paho closed the socket
+        self._fd = None
+        self._mqttConn.on_socket_open = self._on_socket_open
+        self._mqttConn.on_socket_close = self._on_socket_close
+        self._mqttConn.on_socket_register_write = self._on_socket_register_write
+        self._mqttConn.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def call_in_loop(self, callback, *args):
+        # connect and reconnect block, they run in an executor thread and call back from there
+        if threading.get_ident() == self.loop_thread:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def _watch_socket(self, client, fd):
+        self.loop.add_reader(fd, client.loop_read)
+        if self._misc is None:
+            self._misc = self.loop.create_task(self._misc_loop())
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._fd = sock.fileno()
+        self.call_in_loop(self._watch_socket, client, self._fd)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.call_in_loop(self.loop.remove_reader, self._fd)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self.call_in_loop(self.loop.add_writer, self._fd, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self.call_in_loop(self.loop.remove_writer, self._fd)
+
+    async def _misc_loop(self):
+        # keepalive and retry handling, paho expects loop_misc about once per second
+        while True:
+            if self._mqttConn.loop_misc() != mqtt.MQTT_ERR_SUCCESS:
+                try:
+                    self.logger.info("Reconnecting to broker")
+                    await self.loop.run_in_executor(None, self._mqttConn.reconnect)
+                except Exception as e:
+                    self.logger.error('Reconnect problem: %s' % (e))
+            await asyncio.sleep(1)
+
+    async def serve(self):
+        self.register_metrics()
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        # an unreachable broker must not stall Cube polling on the same loop
+        while not await self.loop.run_in_executor(None, self.connect):
+            await asyncio.sleep(5)
+        while True:
+            # only the newest pending value of every topic is sent
+            try:
+                self.receive(await asyncio.wait_for(self.messageQ.get(), self.next_wakeup()))
+            except asyncio.TimeoutError:
+                pass
+            while not self.messageQ.empty():
+                self.receive(self.messageQ.get_nowait())
+            self.publish_pending()
+            self.export_metrics()
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+
+from MaxWorker import MaxWorker
+from maxcube.aio import AsyncMaxCubeConnection, AsyncMaxCube
+
+
+class AsyncMaxWorker(MaxWorker):
+    """MaxWorker running on an asyncio event loop.
+
+    Topology and command handling is inherited, the *_async methods only
+    await the Cube I/O around it.
+    Queues are asyncio.Queue instances shared with AsyncMQTTClient.
+    """
+
+    def __init__(self, messageQ, commandQ, config, metricsQ=None):
+        MaxWorker.__init__(self, messageQ, commandQ, config, metricsQ)
+        self.logger = logging.getLogger('Max!-MQTT.AsyncMaxWorker')
+        self.__commandQ = commandQ
+        self.__connection = None
+        self.__cube = None
+
+    async def get_cube_async(self, refresh=True):
+        if self.__connection is None:
+            self.__connection = AsyncMaxCubeConnection(self.cube_ip_adress, self.cube_port,
+                                                       persistent=self.cube_persistent_session,
+                                                       heartbeat_interval=self.cube_heartbeat_interval)
+            self.__connection.on_timing = self.observe_timing
+        if self.__cube is None:
+            self.__cube = await AsyncMaxCube.create(self.__connection)
+        elif refresh:
+            await self.__cube.update()
+        return self.__cube
+
+    async def refresh_topology_async(self):
+        self.logger.debug('Starting topology refresh')
+        try:
+            cube = await self.get_cube_async()
+            self.process_cube(cube)
+        except Exception as e:
+            self.logger.error(format(e))
+        self.logger.debug('Finished topology refresh')
+        self.refresh_done()
+
+    async def heartbeat_async(self):
+        if self.__cube is None:
+            return
+        try:
+            if await self.__cube.heartbeat():
+                self.heartbeat_done(self.__cube)
+        except Exception as e:
+            self.logger.error('Heartbeat failed: %s' % (format(e)))
+
+    async def execute_command_async(self, cube, task):
+        self.logger.debug("Executing command:%s", task)
+        for call, done in self.command_calls(cube, task):
+            try:
+                await call()
+                done()
+            except Exception as ex:
+                self.logger.error("Send error:%s" % (format(ex)))
+        self.command_roundtrip.observe(time.time() - task['timestamp'])
+
+    async def execute_commands_async(self, tasks):
+        try:
+            cube = await self.get_cube_async(refresh=False)
+            # whole batch goes over one Cube session
+            async with self.__connection.batch():
+                for task in tasks:
+                    await self.execute_command_async(cube, task)
+        except Exception as e:
+            self.logger.error(format(e))
+
+    def next_heartbeat(self):
+        return None if self.__connection is None else self.__connection.next_heartbeat()
+
+    async def serve(self):
+        self.start_serving()
+        await self.refresh_topology_async()
+        self.update_scheduler_stats()
+        self.flush()
+
+        while True:
+            # sleeps until a command arrives or the nearest timer is due
+            try:
+                task = await asyncio.wait_for(self.__commandQ.get(), self.next_wakeup())
+            except asyncio.TimeoutError:
+                task = None
+            while task is not None:
+                self.receive_command(task, self.__commandQ.qsize())
+                task = None if self.__commandQ.empty() else self.__commandQ.get_nowait()
+            tasks = self.command_scheduler.ready()
+            if tasks:
+                await self.execute_commands_async(tasks)
+
+            if self.poll_scheduler.due():
+                await self.refresh_topology_async()
+            else:
+                await self.heartbeat_async()
+            self.cycle_done()
+
+    def run(self):
+        asyncio.run(self.serve())
@@ -0,0 +1,120 @@
+import collections
+import time
+
+PRIORITY_USER = 0
+PRIORITY_CORRECTION = 1
+
+
+class DutyCycleBudget(object):
+    """Estimate of the Cube RF duty cycle budget.
+
+    Cube reports used budget in percent in the greeting and in every S: reply,
+    the usage is assumed to recover linearly over window seconds. Cost of one
+    command is learned from the reported increases. Every priority has its own
+    limit, so sanity check corrections leave a reserve for user commands.
+    """
+
+    def __init__(self, window=3600, limits=(90, 50), cost=1.0):
+        self.window = window
+        self.limits = limits
+        self.cost = cost
+        self.used = 0.0
+        self.updated = time.time()
+        self.free_mem_slots = None
+
+    def estimate(self, now=None):
+        if now is None:
+            now = time.time()
+        return max(0.0, self.used - (now - self.updated) * 100.0 / self.window)
+
+    def update(self, duty_cycle, free_mem_slots, commands=0, now=None):
+        if now is None:
+            now = time.time()
+        if commands:
+            increase = duty_cycle - self.estimate(now)
+            if increase > 0:
+                self.cost = 0.8 * self.cost + 0.2 * increase / commands
+        self.used = float(duty_cycle)
+        self.free_mem_slots = free_mem_slots
+        self.updated = now
+
+    def wait_time(self, priority, queued=0, now=None):
+        """Seconds until another command of given priority fits, queued commands are sent before it."""
+        if self.free_mem_slots == 0:
+            # Cube has no room for more commands, give it time to deliver them
+            return self.window / 60.0
+        excess = self.estimate(now) + self.cost * (queued + 1) - self.limits[priority]
+        return max(0.0, excess * self.window / 100.0)
+
+
+class CommandScheduler(object):
+    """Pending Cube commands, only the latest command per device and parameter is kept.
+
+    A command becomes due after the debounce time without newer command for
+    the same device and parameter, so a burst of updates (e.g. a slider being
+    dragged) results in one RF transmission. Debouncing is capped at
+    max_delay since the first command of the burst. Due commands are released
+    in priority order while the duty cycle budget allows, the rest is deferred.
+    """
+
+    def __init__(self, debounce, budget=None, max_delay=None):
+        self.debounce = debounce
+        self.budget = budget
+        self.max_delay = max_delay if max_delay is not None else debounce * 4
+        # (device, param) -> [task, first_seen, due, priority]
+        self.pending = collections.OrderedDict()
+        self.merged = 0
+        self.deferred = 0
+
+    def add(self, task, priority=PRIORITY_USER, debounce=None, now=None):
+        if now is None:
+            now = time.time()
+        if debounce is None:
+            debounce = self.debounce
+        key = (task['deviceId'], task['param'])
+        entry = self.pending.get(key)
+        if entry is None:
+            self.pending[key] = [task, now, now + debounce, priority]
+        elif priority <= entry[3]:
+            self.merged += 1
+            entry[0] = task
+            entry[2] = min(now + debounce, entry[1] + self.max_delay)
+            entry[3] = priority
+        # lower priority command never replaces a pending user command
+
+    def ready(self, now=None):
+        if now is None:
+            now = time.time()
+        due = sorted((entry[3], entry[2], key) for key, entry in self.pending.items() if entry[2] <= now)
+        tasks = []
+        for priority, _, key in due:
+            entry = self.pending[key]
+            if self.budget is not None:
+                wait = self.budget.wait_time(priority, len(tasks), now)
+                if wait > 0:
+                    self.deferred += 1
+                    entry[2] = now + wait
+                    continue
+            tasks.append(entry[0])
+            del self.pending[key]
+        return tasks
+
+    def next_due(self):
+        if not self.pending:
+            return None
+        return min(entry[2] for entry in self.pending.values())
+
+    def eta(self, now=None):
+        """Estimated seconds until all pending commands are sent."""
+        if now is None:
+            now = time.time()
+        eta = 0.0
+        for queued, entry in enumerate(sorted(self.pending.values(), key=lambda e: (e[3], e[2]))):
+            wait = max(0.0, entry[2] - now)
+            if self.budget is not None:
+                wait = max(wait, self.budget.wait_time(entry[3], queued, now))
+            eta = max(eta, wait)
+        return eta
+
+    def __len__(self):
+        return len(self.pending)
@@ -0,0 +1,209 @@
+import array
+import bisect
+import collections
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HISTORY_METRICS = ('actual_temperature', 'target_temperature', 'valve_position')
+# head and size of one series in the memory mapped file, followed by its times and values
+SLOT_HEADER = struct.Struct('<qq')
+
+
+class SeriesBuffer(object):
+    """Fixed size ring of (timestamp, value) samples kept in two double arrays."""
+
+    __slots__ = ('capacity', 'times', 'values', 'head', 'size', 'dirty')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array.array('d', bytes(8 * capacity))
+        self.values = array.array('d', bytes(8 * capacity))
+        # next slot to write
+        self.head = 0
+        self.size = 0
+        self.dirty = False
+
+    def append(self, timestamp, value):
+        self.times[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.dirty = True
+
+    def window(self, start, end):
+        """(times, values) arrays of samples between start and end, oldest first.
+
+        Samples are recorded on change, so the last sample before start is
+        included as well, moved to start.
+        """
+        if self.size < self.capacity:
+            times, values = self.times[:self.size], self.values[:self.size]
+        else:
+            times = self.times[self.head:] + self.times[:self.head]
+            values = self.values[self.head:] + self.values[:self.head]
+        lo = bisect.bisect_left(times, start)
+        hi = bisect.bisect_right(times, end)
+        if 0 < lo and lo <= hi:
+            return array.array('d', [start]) + times[lo:hi], values[lo - 1:hi]
+        return times[lo:hi], values[lo:hi]
+
+
+def durations(times, end):
+    """Seconds every sample was in effect, until the next sample or end."""
+    return [max(0.0, until - since) for since, until in zip(times, list(times[1:]) + [end])]
+
+
+def aggregate(windows, end, demand=False):
+    """min, max, time weighted mean and count of the (times, values) windows ending at end.
+
+    demand is the share of time with a non zero value. Samples in effect for
+    no time at all, e.g. a window ending at its only sample, are averaged
+    with equal weights.
+    """
+    windows = [(times, values) for times, values in windows if len(values)]
+    if not windows:
+        return None
+    if numpy is not None:
+        values = numpy.concatenate([numpy.frombuffer(values, dtype=numpy.float64) for _, values in windows])
+        weights = numpy.concatenate([numpy.diff(numpy.append(numpy.frombuffer(times, dtype=numpy.float64), end))
+                                     for times, _ in windows]).clip(0)
+        if not weights.sum():
+            weights = numpy.ones(values.size)
+        result = {'min': float(values.min()), 'max': float(values.max()),
+                  'mean': float(numpy.dot(values, weights) / weights.sum()), 'count': int(values.size)}
+        if demand:
+            result['demand'] = float(weights[values != 0].sum() / weights.sum())
+        return result
+    values = [value for _, window in windows for value in window]
+    weights = [weight for times, _ in windows for weight in durations(times, end)]
+    if not sum(weights):
+        weights = [1.0] * len(values)
+    total = sum(weights)
+    result = {'min': min(values), 'max': max(values),
+              'mean': sum(value * weight for value, weight in zip(values, weights)) / total, 'count': len(values)}
+    if demand:
+        result['demand'] = sum(weight for value, weight in zip(values, weights) if value) / total
+    return result
+
+
+class HistoryStore(object):
+    """Recent samples of device metrics, optionally mirrored to a memory mapped file.
+
+    Every (device, metric) series is a ring of capacity samples. flush()
+    copies changed series into fixed size slots of the file, the order of
+    series is kept in path + '.index'. Aggregates are weighted by the time
+    every value was in effect and use numpy when installed.
+    """
+
+    def __init__(self, capacity=1440, path=None):
+        self.logger = logging.getLogger('Max!-MQTT.HistoryStore')
+        self.capacity = capacity
+        self.path = path
+        self.index_path = None if path is None else path + '.index'
+        self.slot_size = SLOT_HEADER.size + 16 * capacity
+        # (device_id, metric) -> SeriesBuffer, in slot order
+        self.series = collections.OrderedDict()
+        self.mmap = None
+        # number of series listed in the index file
+        self.mapped = 0
+
+    def record(self, device_id, metric, value, now=None):
+        if value is None:
+            return
+        if now is None:
+            now = time.time()
+        series = self.series.get((device_id, metric))
+        if series is None:
+            series = self.series[(device_id, metric)] = SeriesBuffer(self.capacity)
+        series.append(now, value)
+
+    def query(self, device_ids, metric, start, end, demand=False, now=None):
+        """Aggregate of every device and of all devices together, None where no value is known in the window."""
+        if now is None:
+            now = time.time()
+        # the last value is only known to hold until now
+        end = min(end, now)
+        windows = {}
+        for device_id in device_ids:
+            series = self.series.get((device_id, metric))
+            if series is not None:
+                windows[device_id] = series.window(start, end)
+        devices = {}
+        for device_id, window in windows.items():
+            result = aggregate([window], end, demand)
+            if result is not None:
+                devices[device_id] = result
+        return devices, aggregate(list(windows.values()), end, demand)
+
+    def load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.index_path, encoding='utf-8') as index_file:
+                index = json.load(index_file)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            self.logger.error("History index load failed: %s" % e)
+            return
+        if index.get('capacity') != self.capacity:
+            self.logger.info("History size changed, starting empty history")
+            return
+        if not index['series']:
+            return
+        self.map(len(index['series']))
+        for slot, (device_id, metric) in enumerate(index['series']):
+            offset = slot * self.slot_size
+            head, size = SLOT_HEADER.unpack_from(self.mmap, offset)
+            series = self.series[(device_id, metric)] = SeriesBuffer(self.capacity)
+            offset += SLOT_HEADER.size
+            series.times = array.array('d', self.mmap[offset:offset + 8 * self.capacity])
+            offset += 8 * self.capacity
+            series.values = array.array('d', self.mmap[offset:offset + 8 * self.capacity])
+            series.head, series.size = head, size
+        self.mapped = len(self.series)
+        self.logger.info("History loaded, %d series" % self.mapped)
+
+    def map(self, slots):
+        if self.mmap is not None:
+            self.mmap.close()
+        with open(self.path, 'a+b') as data:
+            if os.fstat(data.fileno()).st_size < slots * self.slot_size:
+                data.truncate(slots * self.slot_size)
+        with open(self.path, 'r+b') as data:
+            self.mmap = mmap.mmap(data.fileno(), slots * self.slot_size)
+
+    def write_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as index_file:
+            json.dump({'capacity': self.capacity, 'series': list(self.series)}, index_file, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    def flush(self):
+        if self.path is None or not self.series:
+            return
+        if len(self.series) > self.mapped:
+            # slots of new series are appended, existing slots keep their offset
+            self.map(len(self.series))
+            self.write_index()
+            self.mapped = len(self.series)
+        for slot, series in enumerate(self.series.values()):
+            if not series.dirty:
+                continue
+            offset = slot * self.slot_size
+            SLOT_HEADER.pack_into(self.mmap, offset, series.head, series.size)
+            offset += SLOT_HEADER.size
+            self.mmap[offset:offset + 8 * self.capacity] = memoryview(series.times).cast('B')
+            offset += 8 * self.capacity
+            self.mmap[offset:offset + 8 * self.capacity] = memoryview(series.values).cast('B')
+            series.dirty = False
+        self.mmap.flush()
@@ -1,13 +1,16 @@
 import logging
 import multiprocessing
+import queue
 import time
 
 import paho.mqtt.client as mqtt
-import paho.mqtt.publish as publish
+
+from MessagePipeline import PublishPipeline, prepare_command
+from Metrics import REGISTRY
 
 
 class MQTTClient(multiprocessing.Process):
-    def __init__(self, messageQ, commandQ, config):
+    def __init__(self, messageQ, commandQ, config, metricsQ=None):
         self.logger = logging.getLogger('Max!-MQTT.MQTTClient')
         self.logger.info("Starting...")
 
@@ -20,61 +23,137 @@ class MQTTClient(multiprocessing.Process):
         self.mqtt_port = config['mqtt_port']
         self._mqttConn = mqtt.Client(client_id='Max!-MQTT'
                                                '', clean_session=True, userdata=None)
+        # all publishes share this connection, qos>0 messages are windowed by paho
+        self._mqttConn.max_inflight_messages_set(config.get('mqtt_max_inflight', 20))
+        self._mqttConn.max_queued_messages_set(config.get('mqtt_max_queued', 1000))
 
-        self._mqttConn.connect(self.mqtt_host, port=self.mqtt_port, keepalive=120)
+        self._mqttConn.on_connect = self._on_connect
         self._mqttConn.on_disconnect = self._on_disconnect
         self._mqttConn.on_publish = self._on_publish
         self._mqttConn.on_message = self._on_message
 
         self.message_timeout = config['mqtt_message_timeout']
 
+        self.pipeline = PublishPipeline(self.message_timeout, config.get('mqtt_retry_queue_size', 1000))
+        # metrics snapshots go to the process serving the metrics endpoint
+        self.metricsQ = metricsQ
+        self.metrics_export_interval = config.get('metrics_export_interval', 5)
+        self.metrics_exported = 0
+        self.published_total = None
+        self.acknowledged_total = None
+        self.batch_age = None
+
+    def register_metrics(self):
+        # called where the client runs, in multiprocess mode the metrics belong to the child process
+        self.published_total = REGISTRY.counter('mqtt_published_total', 'Messages handed to the MQTT client')
+        self.acknowledged_total = REGISTRY.counter('mqtt_acknowledged_total', 'Messages acknowledged by the broker')
+        self.batch_age = REGISTRY.histogram('gateway_message_queue_age_seconds',
+                                            'Time batches spent in message queue')
+
     def close(self):
         self.logger.info("Closing connection")
         self._mqttConn.disconnect()
 
+    def connect(self):
+        # connected where the client runs, in multiprocess mode the socket belongs to the child process
+        try:
+            self._mqttConn.connect(self.mqtt_host, port=self.mqtt_port, keepalive=120)
+            return True
+        except Exception as e:
+            self.logger.error('Connection problem: %s' % (e))
+            return False
+
+    def _on_connect(self, client, userdata, flags, rc):
+        # subscription is renewed after every reconnect, the session is not kept by the broker
+        self._mqttConn.subscribe([(self.mqttDataPrefix + "/+/+/set", 0),
+                                  (self.mqttDataPrefix + "/+/room/+/+/set", 0),
+                                  (self.mqttDataPrefix + "/history/query", 0)])
+
     def _on_disconnect(self, client, userdata, rc):
+        # reconnected by paho network thread or by the asyncio misc loop
         if rc != 0:
             self.logger.error("Unexpected disconnection.")
-            self._mqttConn.reconnect()
 
     def _on_publish(self, client, userdata, mid):
-        self.logger.debug("Message " + str(mid) + " published.")
+        self.acknowledged_total.inc()
+        self.logger.debug("Message %s published.", mid)
 
     def _on_message(self, client, userdata, message):
-        self.logger.debug("Message received: %s" % (message))
-
-        data = message.topic.replace(self.mqttDataPrefix + "/", "").split("/")
-        data_out = {
-            'method': 'command',
-            'topic': message.topic,
-            'deviceId': data[0],
-            'param': data[1],
-            'payload': message.payload.decode('ascii'),
-            'qos': 1,
-            'timestamp': time.time()
-        }
-        self.commandQ.put(data_out)
+        self.logger.debug("Message received: %s", message)
+
+        data_out = prepare_command(self.mqttDataPrefix, message.topic, message.payload.decode('ascii'))
+        self.commandQ.put_nowait(data_out)
         if message.retain != 0:
             (rc, final_mid) = self._mqttConn.publish(message.topic, None, 1, True)
             self.logger.info("Clearing topic " + message.topic)
 
+    def receive(self, batch):
+        # commandQ is a CommandRouter, it learns which Cube owns the published devices
+        self.commandQ.learn(batch)
+        self.batch_age.observe(max(0.0, time.time() - batch['timestamp']))
+        self.pipeline.add(batch)
+
+    def export_metrics(self):
+        now = time.time()
+        if now < self.metrics_exported + self.metrics_export_interval:
+            return
+        self.metrics_exported = now
+        for name, value in self.pipeline.stats().items():
+            help = 'Publish pipeline %s messages' % name.replace('_', ' ')
+            if name == 'retry_queue':
+                REGISTRY.gauge('mqtt_pipeline_%s' % name, help).set(value)
+            else:
+                # pipeline keeps running totals, the counter catches up with them
+                counter = REGISTRY.counter('mqtt_pipeline_%s_total' % name, help)
+                counter.inc(value - counter.value)
+        REGISTRY.export(self.metricsQ)
+
     def publish(self, task):
-        if task['timestamp'] <= time.time() + self.message_timeout:
-            topic = "%s/%s/%s" % (self.mqttDataPrefix, task['deviceId'], task['param'])
-            try:
-                if task['payload'] is not None:
-                    publish.single(topic, hostname=self.mqtt_host, port=self.mqtt_port, payload=task['payload'])
-                    self.logger.debug('Sending:%s' % (task))
-            except Exception as e:
-                self.logger.error('Publish problem: %s' % (e))
-                self.messageQ.put(task)
+        # expiry is handled by the pipeline, failed tasks go to its retry queue
+        if task['payload'] is None:
+            return
+        topic = "%s/%s/%s" % (self.mqttDataPrefix, task['deviceId'], task['param'])
+        try:
+            info = self._mqttConn.publish(topic, payload=task['payload'], qos=task['qos'],
+                                          retain=task.get('retain', False))
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                # queue full or connection lost, the bounded retry queue keeps the task instead of paho
+                raise Exception(mqtt.error_string(info.rc))
+            self.published_total.inc()
+            self.logger.debug('Sending:%s', task)
+        except Exception as e:
+            self.logger.error('Publish problem: %s' % (e))
+            self.pipeline.failed(task)
+
+    def publish_pending(self):
+        # while the broker is down tasks stay in the pipeline, where they expire
+        if self._mqttConn.is_connected():
+            for task in self.pipeline.drain():
+                self.publish(task)
+
+    def next_wakeup(self):
+        # failed tasks and tasks held while disconnected are retried once a second,
+        # otherwise only a new batch or metrics export wakes the loop
+        deadlines = []
+        if self.pipeline.retries or len(self.pipeline.coalescer):
+            deadlines.append(1)
+        if self.metricsQ is not None:
+            deadlines.append(max(0, self.metrics_exported + self.metrics_export_interval - time.time()))
+        return min(deadlines) if deadlines else None
 
     def run(self):
-        self._mqttConn.subscribe(self.mqttDataPrefix + "/+/+/set")
+        self.register_metrics()
+        while not self.connect():
+            time.sleep(5)
+        # paho network thread waits on the socket, handles keepalive and reconnects
+        self._mqttConn.loop_start()
         while True:
-            while not self.messageQ.empty():
-                task = self.messageQ.get()
-                if task['method'] == 'publish':
-                    self.publish(task)
-            time.sleep(0.01)
-            self._mqttConn.loop()
+            # only the newest pending value of every topic is sent
+            try:
+                self.receive(self.messageQ.get(timeout=self.next_wakeup()))
+                while True:
+                    self.receive(self.messageQ.get_nowait())
+            except queue.Empty:
+                pass
+            self.publish_pending()
+            self.export_metrics()
@@ -1,15 +1,23 @@
+import asyncio
 import json
 import logging
 import multiprocessing
+import queue
+import threading
 import time
 
 import tornado.gen
 import tornado.ioloop
+import tornado.web
 import tornado.websocket
 from tornado.options import options
 
+import AsyncMaxWorker
+import AsyncMQTTClient
 import MQTTClient
 import MaxWorker
+import MessagePipeline
+import Metrics
 
 logger = logging.getLogger('Max!-MQTT')
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(funcName)s - %(levelname)s - %(message)s')
@@ -25,11 +33,101 @@ ch.setLevel(logging.DEBUG)
 logger.addHandler(ch)
 
 
-def main():
+class MetricsHandler(tornado.web.RequestHandler):
+    """Serves metrics of this process, or latest snapshots exported by the worker processes."""
+
+    def initialize(self, snapshots):
+        self.snapshots = snapshots
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        if self.snapshots is None:
+            self.write(Metrics.render([Metrics.REGISTRY.snapshot()]))
+        else:
+            # every series is owned by one child process, the parent registry holds none of them
+            self.write(Metrics.render(list(self.snapshots.values())))
+
+
+def start_metrics_server(config, metricsQ=None):
+    if not config.get('metrics_port'):
+        return
+    # pid -> latest snapshot exported through metricsQ, None when all metrics live in this process
+    snapshots = None if metricsQ is None else {}
+
+    def collect():
+        while True:
+            try:
+                pid, snapshot = metricsQ.get_nowait()
+            except queue.Empty:
+                return
+            snapshots[pid] = snapshot
+
+    if metricsQ is not None:
+        tornado.ioloop.PeriodicCallback(collect, 1000).start()
+    app = tornado.web.Application([(r'/metrics', MetricsHandler, {'snapshots': snapshots})])
+    app.listen(config['metrics_port'], address=config.get('metrics_address', '127.0.0.1'))
+    logger.info('Serving metrics on %s:%s', config.get('metrics_address', '127.0.0.1'), config['metrics_port'])
+
+
+def cube_configs(config):
+    """Returns worker config for every Cube listed in max_cubes, or the single max_cube_ip_adress one."""
+    if 'max_cubes' not in config:
+        return [config]
+    configs = []
+    for index, cube in enumerate(config['max_cubes']):
+        name = cube.get('name', 'cube%d' % (index + 1))
+        cube_config = dict(config)
+        cube_config['max_cube_name'] = name
+        cube_config['max_cube_ip_adress'] = cube['ip']
+        cube_config['max_cube_port'] = cube.get('port', 62910)
+        # topology of every Cube is persisted separately
+        cube_config['max_topology_file'] = 'topology-%s.json' % name
+        if config.get('history_file'):
+            cube_config['history_file'] = 'history-%s.bin' % name
+        configs.append(cube_config)
+    return configs
+
+
+async def run_asyncio(config):
     # messages read from device
-    messageQ = multiprocessing.Queue()
-    # messages written to device
-    commandQ = multiprocessing.Queue()
+    messageQ = asyncio.Queue(config.get('mqtt_queue_size', 100))
+    # messages written to device, one queue per Cube
+    queues = {}
+    workers = []
+    for cube_config in cube_configs(config):
+        commandQ = queues[cube_config.get('max_cube_name', 'cube')] = asyncio.Queue()
+        workers.append(AsyncMaxWorker.AsyncMaxWorker(messageQ, commandQ, cube_config))
+
+    mqtt = AsyncMQTTClient.AsyncMQTTClient(messageQ, MessagePipeline.CommandRouter(queues), config)
+    # tornado runs on the asyncio loop, all metrics live in this process
+    start_metrics_server(config)
+    await asyncio.gather(mqtt.serve(), *(mw.serve() for mw in workers))
+
+
+def run_threads(config):
+    # messages read from device, passed by reference between threads
+    messageQ = MessagePipeline.RingBuffer(config.get('mqtt_queue_size', 100))
+    # messages written to device, one queue and one worker thread per Cube
+    queues = {}
+    threads = []
+    for cube_config in cube_configs(config):
+        commandQ = queues[cube_config.get('max_cube_name', 'cube')] = queue.Queue()
+        mw = MaxWorker.MaxWorker(messageQ, commandQ, cube_config)
+        threads.append(threading.Thread(target=mw.run, name=cube_config.get('max_cube_name', 'cube'), daemon=True))
+
+    mqtt = MQTTClient.MQTTClient(messageQ, MessagePipeline.CommandRouter(queues), config)
+    threads.append(threading.Thread(target=mqtt.run, name='mqtt', daemon=True))
+    for thread in threads:
+        thread.start()
+
+    options.parse_command_line()
+    mainLoop = tornado.ioloop.IOLoop.instance()
+    # all metrics live in this process
+    start_metrics_server(config)
+    mainLoop.start()
+
+
+def main():
     config = {}
     try:
         with open('config.json') as json_data:
@@ -38,11 +136,28 @@ def main():
         logger.error("Config load failed")
         exit(1)
 
-    mw = MaxWorker.MaxWorker(messageQ, commandQ, config)
-    mw.daemon = True
-    mw.start()
+    if config.get('gateway_mode', 'multiprocess') == 'asyncio':
+        # single process, single event loop for both Cube and MQTT side
+        asyncio.run(run_asyncio(config))
+        return
+    if config.get('gateway_mode', 'multiprocess') == 'threads':
+        # single process, Cube workers and MQTT client as threads
+        run_threads(config)
+        return
+
+    # messages read from device
+    messageQ = multiprocessing.Queue(config.get('mqtt_queue_size', 100))
+    # metrics snapshots of worker processes
+    metricsQ = multiprocessing.Queue(100) if config.get('metrics_port') else None
+    # messages written to device, one queue and one worker process per Cube, Cubes are polled in parallel
+    queues = {}
+    for cube_config in cube_configs(config):
+        commandQ = queues[cube_config.get('max_cube_name', 'cube')] = multiprocessing.Queue()
+        mw = MaxWorker.MaxWorker(messageQ, commandQ, cube_config, metricsQ)
+        mw.daemon = True
+        mw.start()
 
-    mqtt = MQTTClient.MQTTClient(messageQ, commandQ, config)
+    mqtt = MQTTClient.MQTTClient(messageQ, MessagePipeline.CommandRouter(queues), config, metricsQ)
     mqtt.daemon = True
     mqtt.start()
 
@@ -51,6 +166,7 @@ def main():
     options.parse_command_line()
 
     mainLoop = tornado.ioloop.IOLoop.instance()
+    start_metrics_server(config, metricsQ)
     mainLoop.start()
 
 
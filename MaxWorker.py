@@ -1,18 +1,49 @@
+import functools
 import json
 import logging
 import multiprocessing
+import queue
 import time
 
+from CommandScheduler import CommandScheduler, DutyCycleBudget, PRIORITY_CORRECTION
+from HistoryStore import HistoryStore, HISTORY_METRICS
+from MessagePipeline import prepare_batch, put_drop_oldest
+from Metrics import REGISTRY, queue_depth
+from PollScheduler import PollScheduler
+from PublishCache import PublishCache
+from TopologyStore import TopologyStore
 from maxcube.connection import MaxCubeConnection
 from maxcube.cube import MaxCube
 from maxcube.device import \
     MAX_THERMOSTAT, \
     MAX_THERMOSTAT_PLUS, \
-    MAX_WALL_THERMOSTAT
+    MAX_WALL_THERMOSTAT, \
+    MAX_WINDOW_SHUTTER
+
+PUBLISHED_PARAMS = ('link_ok', 'battery_ok')
+THERMOSTAT_PARAMS = ('actual_temperature', 'target_temperature', 'valve_position', 'mode')
+SHUTTER_PARAMS = ('is_open',)
+# params published in addition to PUBLISHED_PARAMS, per device type
+DEVICE_PARAMS = {
+    MAX_THERMOSTAT: THERMOSTAT_PARAMS,
+    MAX_THERMOSTAT_PLUS: THERMOSTAT_PARAMS,
+    MAX_WALL_THERMOSTAT: THERMOSTAT_PARAMS,
+    MAX_WINDOW_SHUTTER: SHUTTER_PARAMS,
+}
+# params published from persisted topology on warm start
+STATE_PARAMS = PUBLISHED_PARAMS + THERMOSTAT_PARAMS + SHUTTER_PARAMS
+# topology values differing from the raw device fields
+TOPOLOGY_FORMATTERS = {
+    'type': lambda device: device.device_type_name(),
+    'mode': lambda device: device.device_mode_name(),
+}
+# changes polled faster for a while, actual temperature drifts too slowly to count
+ACTIVITY_FIELDS = frozenset(('valve_position', 'target_temperature', 'mode', 'is_open'))
+MAX_MODES = {'AUTO': 0, 'MANUAL': 1, 'VACATION': 2, 'BOOST': 3}
 
 
 class MaxWorker(multiprocessing.Process):
-    def __init__(self, messageQ, commandQ, config):
+    def __init__(self, messageQ, commandQ, config, metricsQ=None):
         self.logger = logging.getLogger('Max!-MQTT.MaxWorker')
 
         self.logger.info("Starting...")
@@ -23,20 +54,67 @@ class MaxWorker(multiprocessing.Process):
 
         self.topology = {}
         self.desired_temperatures = {}
+        # topology.json snapshot plus journal of changes since the snapshot
+        self.topology_store = TopologyStore(config.get('max_topology_file', 'topology.json'),
+                                            max_journal=config.get('max_topology_journal_size', 1000))
         self.load_topology()
+        # recent samples of HISTORY_METRICS per device, answering [prefix]/history/query
+        self.history = HistoryStore(config.get('history_size', 1440), config.get('history_file'))
+        self.load_history()
         self.__max_cube_connection = None
+        self.__cube = None
 
         self.cube_ip_adress = config['max_cube_ip_adress']
+        self.cube_port = config.get('max_cube_port', 62910)
+        # device id of Cube's own topics, distinguishes Cubes of a multi-Cube setup
+        self.cube_name = config.get('max_cube_name', 'cube')
         self.topology_refresh_period = config['max_topology_refresh_interval']
+        # polls back off towards the max interval while nothing changes
+        self.poll_scheduler = PollScheduler(self.topology_refresh_period,
+                                            config.get('max_topology_refresh_max_interval'),
+                                            boost=config.get('max_topology_refresh_boost_period', 120),
+                                            jitter=config.get('max_topology_refresh_jitter', 0.1))
         self.mqtt_update_period = config['max_mqtt_update_interval']
         self.cube_duty_cycle_reset_interval = config['max_cube_duty_cycle_reset_interval']
         self.enable_sanity_check = config['max_perform_sanity_check']
+        # unchanged values are republished once per MQTT update interval
+        self.publish_cache = PublishCache(self.mqtt_update_period)
+        # messages are sent to MQTT side as one batch per loop pass
+        self.__batch = []
+        # last known state is published (retained) from persisted topology before the first Cube poll
+        self.warm_start = config.get('max_warm_start', False)
+        # devices published from persisted topology and not yet confirmed by the Cube
+        self.stale_devices = set()
+        self.cube_persistent_session = config.get('max_cube_persistent_session', False)
+        self.cube_heartbeat_interval = config.get('max_cube_heartbeat_interval', 60)
+        # latest command per device and parameter, sent after a short debounce
+        # commands are paced by estimated RF duty cycle budget, user commands go first
+        self.duty_cycle_budget = DutyCycleBudget(
+            window=self.cube_duty_cycle_reset_interval,
+            limits=(config.get('max_duty_cycle_limit', 90), config.get('max_duty_cycle_correction_limit', 50)))
+        self.command_scheduler = CommandScheduler(config.get('max_command_debounce', 0.5), self.duty_cycle_budget)
+        # metrics snapshots go to the process serving the metrics endpoint
+        self.metricsQ = metricsQ
+        self.metrics_export_interval = config.get('metrics_export_interval', 5)
+        self.metrics_exported = 0
+        self.timing_metrics = {}
+        self.commands_received = None
+        self.command_age = None
+        self.command_roundtrip = None
 
-
-        self.topology_last_refresh = 0
         self.mqtt_last_refresh = 0
-        self.cube_duty_cycle = 0
-        self.cube_duty_cycle_reset = 0
+
+    def register_metrics(self):
+        # called where the worker runs, in multiprocess mode the metrics belong to the child process
+        self.commands_received = REGISTRY.counter('gateway_commands_received_total', 'Commands received from MQTT',
+                                                  cube=self.cube_name)
+        self.command_age = REGISTRY.histogram('gateway_command_queue_age_seconds',
+                                              'Time commands spent in command queue', cube=self.cube_name)
+        self.command_roundtrip = REGISTRY.histogram('gateway_command_roundtrip_seconds',
+                                                    'Time from MQTT command to Cube reply', cube=self.cube_name)
+        self.dropped_batches = REGISTRY.counter('gateway_message_batches_dropped_total',
+                                                'Batches dropped because message queue was full',
+                                                cube=self.cube_name)
 
     def update_timer_elapsed(self):
         if time.time() > (self.mqtt_last_refresh + self.mqtt_update_period):
@@ -46,110 +124,142 @@ class MaxWorker(multiprocessing.Process):
 
     def load_topology(self):
         try:
-            with open('topology.json') as json_data:
-                d = json.load(json_data)
-                self.topology = d
-                self.logger.info("topology initial load suceeded")
+            self.topology = self.topology_store.load()
+            self.logger.info("topology initial load suceeded")
+        except Exception as e:
+            self.logger.error("Topology initial load failed: %s" % format(e))
+
+    def load_history(self):
+        try:
+            self.history.load()
         except Exception as e:
-            self.logger.error("Topology initial load failed")
+            self.logger.error("History load failed: %s" % format(e))
 
     def refresh_topology(self):
-        time.sleep(0.01)
         self.logger.debug('Starting topology refresh')
         try:
-            self.connect()
-            cube = MaxCube(self.__max_cube_connection)
-            #TODO report cube values to the broker
-            # self.__messageQ.put(self.prepare_output('cube', 'free_mem_slots', cube.free_mem_slots))
-            # self.__messageQ.put(self.prepare_output('cube', 'duty_cycle', cube.duty_cycle))
-            for device in cube.devices:
-                device_id = self.update_device(device)
-                if device.type in (MAX_THERMOSTAT, MAX_THERMOSTAT_PLUS, MAX_WALL_THERMOSTAT) \
-                        and self.enable_sanity_check \
-                        and (device_id in self.desired_temperatures) \
-                        and (self.desired_temperatures[device_id] != device.target_temperature):
-                    try:
-                        self.logger.info("Correcting temperature for device :%s (%s/%s) from:%s to:%s" % (
-                            device_id, device.room_name, device.name, device.target_temperature,
-                            self.desired_temperatures[device_id]))
-                        cube.set_target_temperature(device, self.desired_temperatures[device_id])
-                        self.logger.info("Command result:%s" % cube.command_result)
-                        if cube.command_success:
-                            self.__messageQ.put(self.prepare_output(
-                                device_id, 'target_temperature',
-                                self.topology[device_id]['target_temperature']))
-                            self.__messageQ.put(self.prepare_output(
-                                'cube', 'free_mem_slots', cube.free_mem_slots))
-                            self.__messageQ.put(self.prepare_output(''
-                                                                    'cube', 'duty_cycle', cube.duty_cycle))
-                            self.cube_duty_cycle = cube.duty_cycle
-                            self.cube_duty_cycle_reset = time.time()
-
-                    except Exception as e:
-                        self.logger.error("Set error:%s" % (format(e)))
+            cube = self.get_cube()
+            self.process_cube(cube)
         except Exception as e:
             self.logger.error(format(e))
         self.logger.debug('Finished topology refresh')
+        self.refresh_done()
+        return (True)
+
+    def refresh_done(self):
+        self.poll_scheduler.polled()
         if self.update_timer_elapsed():
             self.mqtt_last_refresh = time.time()
             self.dump_topology()
-        return (True)
+
+    def process_cube(self, cube):
+        # only devices with new values since previous poll are processed
+        self.update_cube_stats(cube)
+        for device in cube.pop_changed_devices():
+            self.update_device(device)
+        for device_id in cube.pop_removed_devices():
+            self.remove_device(device_id)
+        if self.stale_devices:
+            self.reconcile_stale_devices(cube)
+        for device_id in self.desired_temperatures:
+            device = cube.device_by_serial(device_id)
+            if device is not None and self.needs_correction(device_id, device):
+                self.schedule_correction(device_id, device)
+
+    def remove_device(self, device_id):
+        # unpaired device, its last values are no longer republished nor corrected
+        self.logger.info("Device %s removed from Cube" % device_id)
+        self.publish_cache.invalidate(device_id)
+        self.desired_temperatures.pop(device_id, None)
+        self.stale_devices.discard(device_id)
+
+    def publish_persisted_state(self):
+        for device_id, entry in self.topology.items():
+            for param in STATE_PARAMS:
+                if param in entry:
+                    self.publish(device_id, param, entry[param])
+            self.publish(device_id, 'stale', True)
+            self.stale_devices.add(device_id)
+        self.logger.info("Published persisted state of %d devices" % len(self.stale_devices))
+
+    def reconcile_stale_devices(self, cube):
+        # values differing from the persisted ones were already published by update_device()
+        for device_id in list(self.stale_devices):
+            if cube.device_by_serial(device_id) is not None:
+                self.stale_devices.discard(device_id)
+                self.publish(device_id, 'stale', False)
+
+    def publish_heartbeats(self):
+        for topic, value in self.publish_cache.due():
+            device_id, param_name = topic.split('/', 1)
+            self.publish(device_id, param_name, value)
+
+    def schedule_correction(self, device_id, device):
+        self.logger.info("Correcting temperature for device :%s (%s/%s) from:%s to:%s" % (
+            device_id, device.room_name, device.name, device.target_temperature,
+            self.desired_temperatures[device_id]))
+        self.command_scheduler.add(self.prepare_command(device_id, 'target_temperature',
+                                                        self.desired_temperatures[device_id]),
+                                   priority=PRIORITY_CORRECTION, debounce=0)
+
+    def prepare_command(self, device_id, param_name, param_value):
+        out = {
+            'method': 'command',
+            'deviceId': device_id,
+            'param': param_name,
+            'payload': param_value,
+            'qos': 1,
+            'timestamp': time.time()
+        }
+        return out
 
     def update_device(self, device):
         device_id = device.serial
-        if not device_id in self.topology:
-            self.topology[device_id] = {}
-
-        self.topology[device_id]['rf_address'] = device.rf_address
-        self.topology[device_id]['name'] = device.name
-        self.topology[device_id]['room_id'] = device.room_id
-        self.topology[device_id]['room_name'] = device.room_name
-        self.topology[device_id]['type'] = device.device_type_name()
-        self.topology[device_id]['serial'] = device.serial
-        self.update_device_metric(device, 'link_ok')
-        self.update_device_metric(device, 'battery_ok')
-
-        # metrics available only for specific device types
-        if device.type in (MAX_THERMOSTAT, MAX_THERMOSTAT_PLUS, MAX_WALL_THERMOSTAT):
-            self.topology[device_id]['mode'] = device.device_mode_name()
-            if device.actual_temperature:
-                self.update_device_metric(device, 'actual_temperature')
-            self.update_device_metric(device, 'target_temperature')
-            self.update_device_metric(device, 'valve_position')
-
-        # send data to MQTT
-        self.logger.debug("Refreshing data in MQTT for device :%s (%s/%s)" %
-                          (device_id, device.room_name, device.name))
-        self.__messageQ.put(self.prepare_output(
-            device_id, 'actual_temperature', self.topology[device_id].get('actual_temperature', None)))
-        self.__messageQ.put(self.prepare_output(
-            device_id, 'target_temperature', self.topology[device_id]['target_temperature']))
-        self.__messageQ.put(self.prepare_output(
-            device_id, 'link_ok', self.topology[device_id]['link_ok']))
-        self.__messageQ.put(self.prepare_output(
-            device_id, 'battery_ok', self.topology[device_id]['battery_ok']))
-        self.__messageQ.put(self.prepare_output(
-            device_id, 'valve_position', self.topology[device_id]['valve_position']))
-        self.__messageQ.put(self.prepare_output(
-            device_id, 'mode', self.topology[device_id]['mode']))
+
+        # only fields written with a new value since previous update are copied
+        dirty = device.pop_dirty()
+        if not dirty.isdisjoint(ACTIVITY_FIELDS):
+            self.poll_scheduler.activity()
+        for field in dirty:
+            formatter = TOPOLOGY_FORMATTERS.get(field)
+            self.topology_store.set(device_id, field, formatter(device) if formatter else getattr(device, field))
+        entry = self.topology.get(device_id, {})
+
+        # send changed data to MQTT, unchanged values are refreshed by publish_heartbeats()
+        for param in PUBLISHED_PARAMS + DEVICE_PARAMS.get(device.type, ()):
+            if param in dirty:
+                self.publish(device_id, param, entry[param])
+        # history keeps a sample per change
+        for param in HISTORY_METRICS:
+            if param in dirty:
+                self.history.record(device_id, param, entry[param])
         return device_id
 
     def dump_topology(self):
         try:
-            with open('topology.json', 'w') as outfile:
-                json.dump(self.topology, outfile, ensure_ascii=False)
+            # appends changes to the journal, the snapshot is rewritten when the journal is full
+            self.topology_store.flush()
         except Exception as e:
             self.logger.error(format(e))
-
-    def update_device_metric(self, device, param):
-        device_id = device.serial
         try:
-            if self.topology[device_id].get(param, None) != device.__dict__[param]:
-                self.topology[device_id][param] = device.__dict__[param]
-                self.__messageQ.put(self.prepare_output(device_id, param,
-                                                        self.topology[device_id].get(param, None)))
+            self.history.flush()
         except Exception as e:
-            self.logger.error("problem while udating param %s in device %s" % (param, device_id))
+            self.logger.error("History flush failed: %s" % format(e))
+
+    def publish(self, device_id, param_name, param_value):
+        topic = device_id + '/' + param_name
+        if not self.publish_cache.should_publish(topic, param_value):
+            return
+        self.__batch.append(self.prepare_output(device_id, param_name, param_value))
+
+    def flush(self):
+        if not self.__batch:
+            return
+        dropped = put_drop_oldest(self.__messageQ, prepare_batch(self.__batch, self.cube_name))
+        if dropped:
+            self.dropped_batches.inc(dropped)
+            self.logger.warning("Message queue full, dropped %s oldest batches" % (dropped))
+        self.__batch = []
 
     def prepare_output(self, device_id, param_name, param_value):
         out = {
@@ -158,6 +268,7 @@ class MaxWorker(multiprocessing.Process):
             'param': param_name,
             'payload': param_value,
             'qos': 1,
+            'retain': self.warm_start,
             'timestamp': time.time()
         }
         return out
@@ -165,7 +276,10 @@ class MaxWorker(multiprocessing.Process):
     def connect(self):
         if self.__max_cube_connection is None:
             try:
-                self.__max_cube_connection = MaxCubeConnection(self.cube_ip_adress, 62910)
+                self.__max_cube_connection = MaxCubeConnection(self.cube_ip_adress, self.cube_port,
+                                                               persistent=self.cube_persistent_session,
+                                                               heartbeat_interval=self.cube_heartbeat_interval)
+                self.__max_cube_connection.on_timing = self.observe_timing
                 self.logger.info('Connecting to Max!Cube')
             except Exception as e:
                 self.logger.error('Problem opening connection')
@@ -173,93 +287,315 @@ class MaxWorker(multiprocessing.Process):
     def close(self):
         if not self.__max_cube_connection is None:
             try:
-                self.__max_cube_connection.disconnect()
+                self.__max_cube_connection.close()
             except:
                 self.logger.error('Problem closing connection')
             self.__max_cube_connection = None
+            self.__cube = None
             self.logger.debug('Connection to Max!Cube closed')
 
-    def set_temperature(self, cube, device_id, target_temperature):
-        device = self.topology[device_id]
-        self.desired_temperatures[device_id] = float(target_temperature)
-        if float(device['target_temperature']) != float(target_temperature):
-            rf_id = device['rf_address']
+    def get_cube(self, refresh=True):
+        # one MaxCube is kept, metadata is decoded once and polls only update live values
+        self.connect()
+        if self.__cube is None:
+            self.__cube = MaxCube(self.__max_cube_connection)
+        elif refresh:
+            self.__cube.update()
+        return self.__cube
+
+    def next_heartbeat(self):
+        connection = self.__max_cube_connection
+        return None if connection is None else connection.next_heartbeat()
+
+    def next_wakeup(self):
+        """Seconds until the nearest of refresh, Cube heartbeat, command, MQTT heartbeat or metrics export."""
+        deadlines = [self.poll_scheduler.next_poll,
+                     self.next_heartbeat(),
+                     self.command_scheduler.next_due(),
+                     self.publish_cache.next_due()]
+        if self.metricsQ is not None:
+            deadlines.append(self.metrics_exported + self.metrics_export_interval)
+        return max(0, min(deadline for deadline in deadlines if deadline is not None) - time.time())
+
+    def heartbeat(self):
+        if self.__cube is None:
+            return
+        try:
+            if not self.__max_cube_connection.heartbeat():
+                return
+            self.__cube.parse_response(self.__max_cube_connection.response)
+            self.heartbeat_done(self.__cube)
+        except Exception as e:
+            self.logger.error('Heartbeat failed: %s' % (format(e)))
+
+    def heartbeat_done(self, cube):
+        # heartbeat is an l: request like a poll, its reply counts as one
+        self.process_cube(cube)
+        self.refresh_done()
+
+    def room_command_targets(self, cube, room_id, target_temperature):
+        """(room, thermostats) pairs needing a group frame, 'all' means every room of the Cube."""
+        rooms = list(cube.devices.rooms()) if room_id == 'all' else [int(room_id)]
+        targets = []
+        for room in rooms:
+            thermostats = cube.room_thermostats(room)
+            for device in thermostats:
+                self.desired_temperatures[device.serial] = target_temperature
+            if any(device.target_temperature != target_temperature for device in thermostats):
+                targets.append((room, thermostats))
+        return targets
+
+    def room_command_done(self, cube, thermostats, target_temperature):
+        self.logger.info("Command result:%s" % (cube.command_result))
+        self.poll_scheduler.activity()
+        self.update_cube_stats(cube, commands=1)
+        if cube.command_success:
+            for device in thermostats:
+                self.publish(device.serial, 'target_temperature', target_temperature)
+
+    def update_cube_stats(self, cube, commands=0):
+        # feeds duty cycle reported in greeting or S: reply to the budget estimate
+        if cube.duty_cycle_timestamp is None or cube.duty_cycle_timestamp <= self.duty_cycle_budget.updated:
+            return
+        self.duty_cycle_budget.update(cube.duty_cycle, cube.free_mem_slots, commands,
+                                      now=cube.duty_cycle_timestamp)
+        self.publish(self.cube_name, 'free_mem_slots', cube.free_mem_slots)
+
+    def update_scheduler_stats(self):
+        self.publish(self.cube_name, 'duty_cycle', int(round(self.duty_cycle_budget.estimate())))
+        self.publish(self.cube_name, 'command_queue', len(self.command_scheduler))
+        self.publish(self.cube_name, 'command_eta', int(round(self.command_scheduler.eta())))
+
+    def observe_timing(self, operation, seconds):
+        metric = self.timing_metrics.get(operation)
+        if metric is None:
+            if operation.startswith('parse:'):
+                metric = REGISTRY.histogram('maxcube_parse_seconds', 'Cube message parse time',
+                                            cube=self.cube_name, type=operation[6:])
+            else:
+                metric = REGISTRY.histogram('maxcube_%s_seconds' % operation, 'Cube %s time' % operation,
+                                            cube=self.cube_name)
+            self.timing_metrics[operation] = metric
+        metric.observe(seconds)
+
+    def receive_command(self, task, queue_size=None):
+        self.commands_received.inc()
+        self.command_age.observe(max(0.0, time.time() - task['timestamp']))
+        if queue_size is not None:
+            REGISTRY.gauge('gateway_command_queue_depth', 'Commands waiting in command queue',
+                           cube=self.cube_name).set(queue_size)
+        if task['method'] == 'history_query':
+            # answered from memory, nothing goes to the Cube
+            self.answer_history_query(task)
+        elif self.accepts_command(task):
+            if self.valid_command(task):
+                self.command_scheduler.add(task)
+            else:
+                self.logger.warning("Invalid %s value %s for %s" % (task['param'], task['payload'], task['deviceId']))
+
+    def answer_history_query(self, task):
+        try:
+            request = json.loads(task['payload'])
+            # id becomes one level of the answer topic
+            request_id = str(request.get('id', 'result'))
+            if not request_id or any(char in request_id for char in '/+#'):
+                raise ValueError('id must be a non empty topic level without /, + or #')
+            queries = request.get('queries', [request])
+            results = [self.history_query(query) for query in queries]
+        except Exception as e:
+            self.logger.warning("Invalid history query %s: %s" % (task['payload'], e))
+            return
+        # bypasses the publish cache, answers are not refreshed by heartbeats
+        output = self.prepare_output(self.cube_name, 'history/%s' % request_id, json.dumps(results))
+        output['retain'] = False
+        self.__batch.append(output)
+
+    def history_query(self, query):
+        """Aggregates of one metric over a time window, per device and per room."""
+        metric = query.get('metric', 'actual_temperature')
+        if metric not in HISTORY_METRICS:
+            return {'metric': metric, 'error': 'unknown metric'}
+        end = query.get('end', time.time())
+        start = query.get('start', end - query.get('window', 3600))
+        rooms = {}
+        for device_id, entry in self.topology.items():
+            if 'devices' in query and device_id not in query['devices']:
+                continue
+            if 'room' in query and entry.get('room_id') != query['room']:
+                continue
+            rooms.setdefault(entry.get('room_id'), []).append(device_id)
+        # share of time with open valve tells how long the room was heating
+        demand = metric == 'valve_position'
+        result = {'metric': metric, 'start': start, 'end': end, 'devices': {}, 'rooms': {}}
+        for room_id, device_ids in rooms.items():
+            devices, room = self.history.query(device_ids, metric, start, end, demand)
+            result['devices'].update(devices)
+            # devices of room 0 belong to no room
+            if room is not None and room_id:
+                result['rooms'][str(room_id)] = room
+        return result
+
+    def export_metrics(self):
+        now = time.time()
+        if now < self.metrics_exported + self.metrics_export_interval:
+            return
+        self.metrics_exported = now
+        labels = {'cube': self.cube_name}
+        REGISTRY.gauge('maxcube_duty_cycle_percent', 'Estimated used RF duty cycle budget',
+                       **labels).set(self.duty_cycle_budget.estimate())
+        REGISTRY.gauge('maxcube_duty_cycle_command_cost_percent', 'Learned duty cycle cost of one command',
+                       **labels).set(self.duty_cycle_budget.cost)
+        REGISTRY.gauge('maxcube_free_mem_slots', 'Free command slots reported by the Cube',
+                       **labels).set(self.duty_cycle_budget.free_mem_slots)
+        REGISTRY.gauge('maxcube_poll_interval_seconds', 'Current adaptive topology refresh interval',
+                       **labels).set(self.poll_scheduler.interval)
+        REGISTRY.gauge('gateway_scheduled_commands', 'Commands waiting for debounce or duty cycle budget',
+                       **labels).set(len(self.command_scheduler))
+        REGISTRY.gauge('gateway_message_queue_depth', 'Batches waiting in message queue',
+                       **labels).set(queue_depth(self.__messageQ))
+        REGISTRY.export(self.metricsQ)
+
+    def command_done(self, cube, device_id, param, value):
+        self.logger.info("Command result:%s" % (cube.command_result))
+        # valves react within minutes, poll fast to publish their movement
+        self.poll_scheduler.activity()
+        self.update_cube_stats(cube, commands=1)
+        if cube.command_success:
+            self.publish(device_id, param, value)
+
+    def needs_correction(self, device_id, device):
+        return device.type in (MAX_THERMOSTAT, MAX_THERMOSTAT_PLUS, MAX_WALL_THERMOSTAT) \
+               and self.enable_sanity_check \
+               and (device_id in self.desired_temperatures) \
+               and (self.desired_temperatures[device_id] != device.target_temperature)
+
+    def accepts_command(self, task):
+        if task['method'] == 'room_command':
+            # room ids are local to every Cube, the topic names the Cube
+            return task['param'] == 'target_temperature' and task.get('cube') == self.cube_name and (
+                task['roomId'] == 'all' or
+                any(entry.get('room_id') and str(entry.get('room_id')) == task['roomId']
+                    for entry in self.topology.values()))
+        # with several Cubes a command for a not yet routed device reaches all workers
+        return task['method'] == 'command' and task['deviceId'] in self.topology
+
+    def valid_command(self, task):
+        if task['param'] == 'mode':
+            return task['payload'] in MAX_MODES
+        if task['param'] == 'target_temperature':
             try:
-                self.logger.debug("Setting temperature for %s  (%s/%s) to:%s" %
-                                  (device_id, device['room_name'], device['name'],
-                                   target_temperature))
-                cube.set_target_temperature(cube.device_by_rf(rf_id), float(target_temperature))
-                self.logger.info("Command result:%s" % (cube.command_result))
-                if cube.command_success:
-                    self.update_cube_stats(cube)
-                    self.__messageQ.put(self.prepare_output(
-                        device_id, 'target_temperature', target_temperature))
-            except Exception as ex:
-                self.logger.error("Send error:%s" % (format(ex)))
-        return
-
-    def update_cube_stats(self, cube):
-        self.__messageQ.put(self.prepare_output(
-            'cube', 'free_mem_slots', cube.free_mem_slots))
-        self.__messageQ.put(self.prepare_output(
-            'cube', 'duty_cycle', cube.duty_cycle))
-
-    def set_mode(self, cube,device_id, target_mode):
+                float(task['payload'])
+            except (TypeError, ValueError):
+                return False
+        return True
 
-        modes={'AUTO':0, 'MANUAL':1, 'VACATION':2, 'BOOST':3}
+    def command_calls(self, cube, task):
+        """(call, done) pairs of the task, call sends it to the Cube and done handles the reply.
 
+        Calls of AsyncMaxCube return awaitables, so the sync and async
+        workers only differ in awaiting them.
+        """
+        try:
+            if task['method'] == 'room_command':
+                yield from self.room_temperature_calls(cube, task['roomId'], task['payload'])
+            elif task['param'] == 'target_temperature':
+                yield from self.temperature_calls(cube, task['deviceId'], task['payload'])
+            elif task['param'] == 'mode':
+                yield from self.mode_calls(cube, task['deviceId'], task['payload'])
+        except Exception as ex:
+            # e.g. device removed meanwhile, the other commands of the batch are still sent
+            self.logger.error("Invalid command %s: %s" % (task, format(ex)))
+
+    def temperature_calls(self, cube, device_id, target_temperature):
+        device = self.topology[device_id]
+        target_temperature = float(target_temperature)
+        self.desired_temperatures[device_id] = target_temperature
+        # the frame carries the room id, room mates follow it so their corrections must too
+        thermostat = cube.device_by_serial(device_id)
+        if thermostat is not None and thermostat.room_id:
+            for mate in cube.room_thermostats(thermostat.room_id):
+                self.desired_temperatures[mate.serial] = target_temperature
+        if float(device['target_temperature']) != target_temperature:
+            self.logger.debug("Setting temperature for %s  (%s/%s) to:%s",
+                              device_id, device['room_name'], device['name'],
+                              target_temperature)
+            yield (functools.partial(cube.set_target_temperature, cube.device_by_serial(device_id), target_temperature),
+                   functools.partial(self.command_done, cube, device_id, 'target_temperature', target_temperature))
+
+    def room_temperature_calls(self, cube, room_id, target_temperature):
+        target_temperature = float(target_temperature)
+        for room, thermostats in self.room_command_targets(cube, room_id, target_temperature):
+            self.logger.debug("Setting temperature for room %s (%d thermostats) to:%s",
+                              room, len(thermostats), target_temperature)
+            yield (functools.partial(cube.set_room_target_temperature, room, target_temperature),
+                   functools.partial(self.room_command_done, cube, thermostats, target_temperature))
+
+    def mode_calls(self, cube, device_id, target_mode):
         device = self.topology[device_id]
         if device['mode'] != target_mode:
-            rf_id = device['rf_address']
+            self.logger.debug("Setting mode for %s  (%s/%s) to:%s",
+                              device_id, device['room_name'], device['name'],
+                              target_mode)
+            yield (functools.partial(cube.set_mode, cube.device_by_serial(device_id), MAX_MODES[target_mode]),
+                   functools.partial(self.command_done, cube, device_id, 'mode', target_mode))
+
+    def execute_command(self, cube, task):
+        self.logger.debug("Executing command:%s", task)
+        for call, done in self.command_calls(cube, task):
             try:
-                self.logger.debug("Setting mode for %s  (%s/%s) to:%s" %
-                                  (device_id, device['room_name'], device['name'],
-                                   target_mode))
-                cube.set_mode(cube.device_by_rf(rf_id), modes[target_mode])
-                self.logger.info("Command result:%s" % (cube.command_result))
-                if cube.command_success:
-                    self.__messageQ.put(self.prepare_output(
-                        'cube', 'free_mem_slots', cube.free_mem_slots))
-                    self.__messageQ.put(self.prepare_output(
-                        'cube', 'duty_cycle', cube.duty_cycle))
-                    self.__messageQ.put(self.prepare_output(
-                        device_id, 'mode', target_mode))
+                call()
+                done()
             except Exception as ex:
                 self.logger.error("Send error:%s" % (format(ex)))
-        return
+        self.command_roundtrip.observe(time.time() - task['timestamp'])
 
-    def run(self):
+    def execute_commands(self, tasks):
+        # whole batch goes over one Cube session
+        try:
+            self.connect()
+            with self.__max_cube_connection.batch():
+                cube = self.get_cube(refresh=False)
+                for task in tasks:
+                    self.execute_command(cube, task)
+        except Exception as e:
+            self.logger.error(format(e))
 
-        self.refresh_topology()
-        self.topology_last_refresh = time.time()
+    def start_serving(self):
+        self.register_metrics()
+        if self.warm_start:
+            self.publish_persisted_state()
+            self.flush()
 
+    def cycle_done(self):
+        self.publish_heartbeats()
+        self.update_scheduler_stats()
+        self.flush()
+        self.export_metrics()
+
+    def run(self):
+        self.start_serving()
+        self.refresh_topology()
+        self.update_scheduler_stats()
+        self.flush()
 
         while True:
-            time.sleep(0.01)
-            # resetting internal duty cycle metric
-            if time.time() > (self.cube_duty_cycle_reset + self.cube_duty_cycle_reset_interval):
-                self.cube_duty_cycle = 0
-                self.cube_duty_cycle_reset = time.time()
-                self.__messageQ.put(self.prepare_output(
-                    'cube', 'duty_cycle', self.cube_duty_cycle))
-
-            # processing incoming data
-            if not self.__commandQ.empty():
+            # sleeps until a command arrives or the nearest timer is due
+            try:
+                task = self.__commandQ.get(timeout=self.next_wakeup())
+            except queue.Empty:
+                task = None
+            while task is not None:
+                self.receive_command(task, queue_depth(self.__commandQ))
                 try:
-                    self.connect()
-                    cube = MaxCube(self.__max_cube_connection)
-                    while not self.__commandQ.empty():
-                        task = self.__commandQ.get()
-                        if task['method'] == 'command':
-                            if task['param'] == 'target_temperature':
-                                self.set_temperature(cube,task['deviceId'],task['payload'])
-                            elif task['param'] == 'mode':
-                                self.set_mode(cube,task['deviceId'],task['payload'])
-                            self.logger.debug("Executing command:%s" % (task))
-                except Exception as e:
-                    self.logger.error(format(e))
+                    task = self.__commandQ.get_nowait()
+                except queue.Empty:
+                    task = None
+            tasks = self.command_scheduler.ready()
+            if tasks:
+                self.execute_commands(tasks)
             # refreshing topology
-            if self.update_timer_elapsed():
+            if self.poll_scheduler.due():
                 self.refresh_topology()
-                self.topology_last_refresh = time.time()
-            self.close()
+            elif self.cube_persistent_session:
+                self.heartbeat()
+            self.cycle_done()
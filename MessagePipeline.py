@@ -0,0 +1,245 @@
+import asyncio
+import collections
+import queue
+import threading
+import time
+
+
+def prepare_batch(tasks, cube=None):
+    return {
+        'method': 'batch',
+        'tasks': tasks,
+        'cube': cube,
+        'timestamp': time.time()
+    }
+
+
+def prepare_command(prefix, topic, payload):
+    """Command task of a [prefix]/<device>/<param>/set, [prefix]/<cube>/room/<room>/<param>/set or
+    [prefix]/history/query topic.
+
+    Room commands keep 'room/<room>' as deviceId, so they are debounced per
+    room, and carry the Cube name CommandRouter sends them to. History
+    queries reach every Cube.
+    """
+    data = topic[len(prefix) + 1:].split('/')
+    task = {
+        'method': 'command',
+        'topic': topic,
+        'deviceId': data[0],
+        'param': data[1],
+        'payload': payload,
+        'qos': 1,
+        'timestamp': time.time()
+    }
+    if len(data) == 5 and data[1] == 'room':
+        task['method'] = 'room_command'
+        task['cube'] = data[0]
+        task['deviceId'] = 'room/' + data[2]
+        task['roomId'] = data[2]
+        task['param'] = data[3]
+    elif data == ['history', 'query']:
+        task['method'] = 'history_query'
+    return task
+
+
+def put_drop_oldest(q, item):
+    """Puts item to a bounded multiprocessing or asyncio queue.
+
+    When the queue is full the oldest entries are dropped to make room.
+    Returns number of dropped entries.
+    """
+    dropped = 0
+    while True:
+        try:
+            q.put_nowait(item)
+            return dropped
+        except (queue.Full, asyncio.QueueFull):
+            try:
+                q.get_nowait()
+                dropped += 1
+            except (queue.Empty, asyncio.QueueEmpty):
+                pass
+
+
+class RingBuffer(object):
+    """Bounded FIFO queue for threads of one process.
+
+    Drop-in for the queue.Queue subset used by workers and MQTT clients.
+    Items are passed by reference instead of being pickled through a pipe,
+    slots are allocated once and a single lock guards head and size.
+    """
+
+    def __init__(self, capacity):
+        self.slots = [None] * capacity
+        self.capacity = capacity
+        self.head = 0
+        self.size = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+    def put(self, item, block=True, timeout=None):
+        with self.not_full:
+            if self.size == self.capacity:
+                if not block or not self.not_full.wait_for(lambda: self.size < self.capacity, timeout):
+                    raise queue.Full
+            self.slots[(self.head + self.size) % self.capacity] = item
+            self.size += 1
+            self.not_empty.notify()
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if not self.size:
+                if not block or not self.not_empty.wait_for(lambda: self.size, timeout):
+                    raise queue.Empty
+            item = self.slots[self.head]
+            # slot must not keep the batch alive
+            self.slots[self.head] = None
+            self.head = (self.head + 1) % self.capacity
+            self.size -= 1
+            self.not_full.notify()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return not self.size
+
+
+class CommandRouter(object):
+    """Dispatches commands to the command queue of the Cube owning the device.
+
+    Device to Cube index is learned from batches published by the workers,
+    a command for a device not seen yet goes to every Cube and is executed
+    by the one knowing the device. Room commands name their Cube.
+    """
+
+    def __init__(self, queues):
+        # cube name -> command queue
+        self.queues = queues
+        self.index = {}
+
+    def learn(self, batch):
+        cube = batch.get('cube')
+        if cube is None or batch['method'] != 'batch':
+            return
+        for task in batch['tasks']:
+            self.index[task['deviceId']] = cube
+
+    def route(self, task):
+        cube = task.get('cube') or self.index.get(task['deviceId'])
+        if cube in self.queues:
+            return [self.queues[cube]]
+        return list(self.queues.values())
+
+    def put(self, task):
+        for q in self.route(task):
+            q.put(task)
+
+    def put_nowait(self, task):
+        for q in self.route(task):
+            q.put_nowait(task)
+
+
+class Coalescer(object):
+    """Pending publish tasks keyed by topic, a newer task replaces the queued one."""
+
+    def __init__(self):
+        self.pending = collections.OrderedDict()
+        self.merged = 0
+
+    def add_task(self, task):
+        key = (task['deviceId'], task['param'])
+        current = self.pending.get(key)
+        if current is not None:
+            self.merged += 1
+            if current['timestamp'] > task['timestamp']:
+                # e.g. a retried task superseded by a fresh value
+                return
+            del self.pending[key]
+        self.pending[key] = task
+
+    def drain(self):
+        tasks = list(self.pending.values())
+        self.pending.clear()
+        return tasks
+
+    def __len__(self):
+        return len(self.pending)
+
+
+class PublishPipeline(object):
+    """Coalescing, expiry and retry stage in front of the MQTT connection.
+
+    Tasks older than message_timeout are dropped before publishing. Failed
+    tasks wait in a bounded retry queue keyed by topic and are superseded by
+    any newer value of the same topic.
+    """
+
+    def __init__(self, message_timeout, retry_size):
+        self.coalescer = Coalescer()
+        self.retries = collections.OrderedDict()
+        self.message_timeout = message_timeout
+        self.retry_size = retry_size
+
+        self.expired = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def add(self, item):
+        if item['method'] == 'batch':
+            tasks = item['tasks']
+        elif item['method'] == 'publish':
+            tasks = (item,)
+        else:
+            return
+        for task in tasks:
+            key = (task['deviceId'], task['param'])
+            retry = self.retries.get(key)
+            if retry is not None and retry['timestamp'] <= task['timestamp']:
+                del self.retries[key]
+            self.coalescer.add_task(task)
+
+    def failed(self, task):
+        key = (task['deviceId'], task['param'])
+        self.retries.pop(key, None)
+        if len(self.retries) >= self.retry_size:
+            self.retries.popitem(last=False)
+            self.dropped += 1
+        self.retries[key] = task
+
+    def is_expired(self, task, now):
+        return now > task['timestamp'] + self.message_timeout
+
+    def drain(self):
+        if self.retries:
+            for task in self.retries.values():
+                self.retried += 1
+                self.coalescer.add_task(task)
+            self.retries.clear()
+
+        now = time.time()
+        tasks = []
+        for task in self.coalescer.drain():
+            if self.is_expired(task, now):
+                self.expired += 1
+                continue
+            tasks.append(task)
+        return tasks
+
+    def stats(self):
+        return {
+            'expired': self.expired,
+            'retried': self.retried,
+            'dropped': self.dropped,
+            'merged': self.coalescer.merged,
+            'retry_queue': len(self.retries)
+        }
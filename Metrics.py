@@ -0,0 +1,155 @@
+import bisect
+import collections
+import os
+import threading
+
+# seconds, fits both local parsing and Cube round trips
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def sample(self):
+        return self.value
+
+
+class Gauge(object):
+    kind = 'gauge'
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def sample(self):
+        return self.value
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # one slot per bucket plus +Inf, cumulated only when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def sample(self):
+        return list(self.buckets), list(self.counts), self.sum
+
+
+class MetricsRegistry(object):
+    """Metrics of one process, rendered in Prometheus text format.
+
+    Metrics are created on first use and identified by name and labels.
+    Every process exports its snapshot() to the process serving the
+    metrics endpoint, render() merges snapshots of all processes.
+    """
+
+    def __init__(self):
+        # in threads mode workers create metrics while the endpoint takes snapshots
+        self.lock = threading.Lock()
+        # name -> (kind, help)
+        self.families = collections.OrderedDict()
+        # (name, labels) -> metric
+        self.metrics = collections.OrderedDict()
+
+    def metric(self, cls, name, help, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = cls()
+                    self.families.setdefault(name, (cls.kind, help))
+        return metric
+
+    def counter(self, name, help='', **labels):
+        return self.metric(Counter, name, help, labels)
+
+    def gauge(self, name, help='', **labels):
+        return self.metric(Gauge, name, help, labels)
+
+    def histogram(self, name, help='', **labels):
+        return self.metric(Histogram, name, help, labels)
+
+    def snapshot(self):
+        """Returns picklable list of (name, kind, help, labels, sample)."""
+        with self.lock:
+            return [(name, self.families[name][0], self.families[name][1], labels, metric.sample())
+                    for (name, labels), metric in self.metrics.items()]
+
+    def export(self, q):
+        """Puts (pid, snapshot) to q, e.g. a multiprocessing queue read by the metrics endpoint."""
+        if q is None:
+            return
+        try:
+            q.put_nowait((os.getpid(), self.snapshot()))
+        except Exception:
+            # metrics are best effort, never block the hot loop
+            pass
+
+
+def queue_depth(q):
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        # multiprocessing queues on macOS
+        return None
+
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in labels)
+
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    return repr(float(value)).replace('inf', 'Inf')
+
+
+def render(snapshots):
+    """Renders samples of several snapshots, grouped by metric family."""
+    families = collections.OrderedDict()
+    for snapshot in snapshots:
+        for name, kind, help, labels, sample in snapshot:
+            families.setdefault(name, (kind, help, []))[2].append((labels, sample))
+
+    lines = []
+    for name, (kind, help, samples) in families.items():
+        if help:
+            lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, sample in samples:
+            if kind == 'histogram':
+                buckets, counts, total = sample
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels, (('le', bound),)), cumulative))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(total)))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), cumulative))
+            else:
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(sample)))
+    return '\n'.join(lines) + '\n'
+
+
+# metrics of the current process
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,49 @@
+import random
+import time
+
+
+class PollScheduler(object):
+    """Topology refresh interval adapting to activity of the Max! network.
+
+    After a command or a poll with changed state the Cube is polled every
+    min_interval for boost seconds. Every later poll without changes
+    multiplies the interval by backoff up to max_interval. Deadlines are
+    jittered by +-jitter of the interval, so polls of several Cubes do not
+    run in lockstep. With max_interval equal to min_interval the interval
+    is fixed.
+    """
+
+    def __init__(self, min_interval, max_interval=None, boost=120, backoff=2.0, jitter=0.1, seed=None):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval or min_interval)
+        self.boost = boost
+        self.backoff = backoff
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.interval = min_interval
+        self.boost_until = 0
+        # first poll right away
+        self.next_poll = 0
+
+    def jittered(self, interval):
+        return interval * (1 + self.random.uniform(-self.jitter, self.jitter))
+
+    def activity(self, now=None):
+        """Command sent or state changed, polls every min_interval for the next boost seconds."""
+        if now is None:
+            now = time.time()
+        self.boost_until = now + self.boost
+        self.interval = self.min_interval
+        self.next_poll = min(self.next_poll, now + self.jittered(self.min_interval))
+
+    def polled(self, now=None):
+        if now is None:
+            now = time.time()
+        if now >= self.boost_until:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        self.next_poll = now + self.jittered(self.interval)
+
+    def due(self, now=None):
+        if now is None:
+            now = time.time()
+        return now >= self.next_poll
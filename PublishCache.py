@@ -0,0 +1,62 @@
+import heapq
+import time
+import zlib
+
+
+class PublishCache(object):
+    """Last published value per topic.
+
+    A value is published only when it differs from the cached one or its
+    heartbeat expired. First heartbeat of every topic is shifted by a phase
+    derived from the topic name, so refreshes of unchanged values are spread
+    over the whole interval instead of being sent in one burst.
+    """
+
+    def __init__(self, heartbeat_interval):
+        self.heartbeat_interval = heartbeat_interval
+        self.values = {}
+        # (deadline, topic), entries superseded by a newer deadline are skipped
+        self.deadlines = []
+
+    def phase(self, topic):
+        return (zlib.crc32(topic.encode('utf-8')) % 1000 + 1) / 1000.0
+
+    def should_publish(self, topic, value, now=None):
+        if now is None:
+            now = time.time()
+        entry = self.values.get(topic)
+        if entry is None:
+            self.schedule(topic, value, now + self.heartbeat_interval * self.phase(topic))
+            return True
+        if entry[0] != value or now >= entry[1]:
+            self.schedule(topic, value, now + self.heartbeat_interval)
+            return True
+        return False
+
+    def schedule(self, topic, value, deadline):
+        self.values[topic] = (value, deadline)
+        heapq.heappush(self.deadlines, (deadline, topic))
+
+    def due(self, now=None):
+        """Returns (topic, value) pairs whose heartbeat expired, without walking all topics."""
+        if now is None:
+            now = time.time()
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, topic = heapq.heappop(self.deadlines)
+            entry = self.values.get(topic)
+            if entry is not None and entry[1] == deadline:
+                expired.append((topic, entry[0]))
+        return expired
+
+    def next_due(self):
+        """Earliest heartbeat deadline, may belong to a superseded entry and wake the caller early."""
+        if not self.deadlines:
+            return None
+        return self.deadlines[0][0]
+
+    def invalidate(self, device_id):
+        """Forgets all topics of the device, its values are no longer refreshed by heartbeats."""
+        prefix = device_id + '/'
+        for topic in [topic for topic in self.values if topic.startswith(prefix)]:
+            del self.values[topic]
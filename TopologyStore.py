@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+
+
+class TopologyStore(object):
+    """Topology kept as a snapshot file plus an append-only journal.
+
+    Changed fields are appended to the journal as [device_id, field, value]
+    lines, the snapshot is rewritten only when the journal grows over
+    max_journal entries. Snapshot goes to a temporary file which is renamed
+    over the previous one, so a crash leaves either the old or the new
+    snapshot. Journal entries hold absolute values, replaying them over a
+    newer snapshot is harmless and a torn last line is skipped.
+    """
+
+    def __init__(self, path='topology.json', max_journal=1000):
+        self.logger = logging.getLogger('Max!-MQTT.TopologyStore')
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.max_journal = max_journal
+        self.topology = {}
+        self.pending = []
+        self.journal_size = 0
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as snapshot:
+                self.topology = json.load(snapshot)
+        except FileNotFoundError:
+            self.logger.info("No topology snapshot found")
+        except Exception as e:
+            self.logger.error("Topology snapshot load failed: %s" % e)
+
+        damaged = False
+        try:
+            with open(self.journal_path, encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        device_id, field, value = json.loads(line)
+                    except ValueError:
+                        self.logger.warning("Skipping damaged topology journal entry")
+                        damaged = True
+                        continue
+                    self.topology.setdefault(device_id, {})[field] = value
+                    self.journal_size += 1
+        except FileNotFoundError:
+            pass
+        if damaged:
+            # new entries must not be appended to a torn line
+            self.snapshot()
+        self.logger.info("Topology loaded, %d devices, %d journal entries replayed" %
+                         (len(self.topology), self.journal_size))
+        return self.topology
+
+    def set(self, device_id, field, value):
+        entry = self.topology.setdefault(device_id, {})
+        if field in entry and entry[field] == value:
+            return
+        entry[field] = value
+        self.pending.append(json.dumps([device_id, field, value], ensure_ascii=False))
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.journal_size + len(self.pending) > self.max_journal:
+            self.snapshot()
+            return
+        with open(self.journal_path, 'a', encoding='utf-8') as journal:
+            journal.write('\n'.join(self.pending) + '\n')
+        self.journal_size += len(self.pending)
+        self.pending = []
+
+    def snapshot(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as snapshot:
+            json.dump(self.topology, snapshot, ensure_ascii=False)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(tmp_path, self.path)
+        # snapshot holds everything journaled so far
+        open(self.journal_path, 'w').close()
+        self.journal_size = 0
+        self.pending = []
@@ -0,0 +1,160 @@
+"""Measures the whole Cube side of the gateway against the local Cube simulator.
+
+Reports Cube poll latency, command round-trip (MQTT command in, confirmed
+value out) and published messages per second. A thread draining the
+message queue stands in for the MQTT broker.
+
+Usage: python bench/end_to_end.py [--rooms R] [--devices-per-room D] [--latency S] [--drop-rate X]
+                                  [--polls N] [--commands N] [--duration S]
+"""
+import argparse
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from MaxWorker import MaxWorker
+from maxcube.connection import MaxCubeConnection
+from maxcube.cube import MaxCube
+from maxcube.device import MAX_WINDOW_SHUTTER
+from maxcube.simulator import CubeSimulator
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(name, values, unit='ms', scale=1e3):
+    if not values:
+        print('%-20s no samples' % name)
+        return
+    print('%-20s n=%-5d avg %8.3f %s  p50 %8.3f %s  p95 %8.3f %s' % (
+        name, len(values), sum(values) / len(values) * scale, unit, percentile(values, 0.5) * scale, unit,
+        percentile(values, 0.95) * scale, unit))
+
+
+def bench_polls(address, polls):
+    connection = MaxCubeConnection(address[0], address[1], persistent=True)
+    start = time.perf_counter()
+    cube = MaxCube(connection)
+    greeting = time.perf_counter() - start
+    samples = []
+    for _ in range(polls):
+        start = time.perf_counter()
+        try:
+            cube.update()
+        except ConnectionError:
+            continue
+        samples.append(time.perf_counter() - start)
+    connection.close()
+    return greeting, samples
+
+
+class BrokerStandIn(threading.Thread):
+    """Drains the message queue like the MQTT client would and records confirmed values."""
+
+    def __init__(self, message_queue):
+        threading.Thread.__init__(self, daemon=True)
+        self.message_queue = message_queue
+        self.messages = 0
+        self.lock = threading.Condition()
+        self.values = {}
+
+    def run(self):
+        while True:
+            batch = self.message_queue.get()
+            with self.lock:
+                for task in batch['tasks']:
+                    self.messages += 1
+                    self.values[(task['deviceId'], task['param'])] = task['payload']
+                self.lock.notify_all()
+
+    def wait_for(self, key, value, timeout):
+        deadline = time.time() + timeout
+        with self.lock:
+            while self.values.get(key) != value:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+
+def bench_gateway(address, thermostats, commands, duration, poll_interval, workdir):
+    config = {
+        'max_cube_ip_adress': address[0],
+        'max_cube_port': address[1],
+        'max_topology_refresh_interval': poll_interval,
+        'max_mqtt_update_interval': poll_interval,
+        'max_cube_duty_cycle_reset_interval': 3600,
+        'max_perform_sanity_check': False,
+        'max_cube_persistent_session': True,
+        'max_command_debounce': 0,
+        'max_topology_file': os.path.join(workdir, 'topology.json'),
+    }
+    message_queue = queue.Queue(1000)
+    command_queue = queue.Queue()
+    broker = BrokerStandIn(message_queue)
+    broker.start()
+    worker = MaxWorker(message_queue, command_queue, config)
+    threading.Thread(target=worker.run, daemon=True).start()
+    # first topology refresh publishes state of every device
+    broker.wait_for((thermostats[0], 'link_ok'), True, 10)
+
+    samples = []
+    for index in range(commands):
+        device_id = thermostats[index % len(thermostats)]
+        # never the simulator's initial 21.0, so every command goes to the Cube
+        target = 17.0 + index % 4 * 0.5
+        start = time.perf_counter()
+        command_queue.put({'method': 'command', 'deviceId': device_id, 'param': 'target_temperature',
+                           'payload': str(target), 'qos': 1, 'timestamp': time.time()})
+        if broker.wait_for((device_id, 'target_temperature'), target, 10):
+            samples.append(time.perf_counter() - start)
+
+    start_messages = broker.messages
+    time.sleep(duration)
+    rate = (broker.messages - start_messages) / duration
+    return samples, rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--devices-per-room', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated Cube response latency in seconds')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='probability a request drops the session')
+    parser.add_argument('--change-rate', type=float, default=0.3, help='probability of a new temperature per poll')
+    parser.add_argument('--poll-interval', type=float, default=0.1)
+    parser.add_argument('--polls', type=int, default=100)
+    parser.add_argument('--commands', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=5.0)
+    args = parser.parse_args()
+
+    simulator = CubeSimulator(args.rooms, args.devices_per_room, shutters=True, latency=args.latency,
+                              drop_rate=args.drop_rate, change_rate=args.change_rate, seed=1).start()
+    thermostats = [device.serial for device in simulator.devices if device.type != MAX_WINDOW_SHUTTER]
+    print('devices: %d, latency: %.3fs, drop rate: %.2f' % (len(simulator.devices), args.latency, args.drop_rate))
+
+    greeting, polls = bench_polls(simulator.address, args.polls)
+    print('%-20s %8.3f ms' % ('greeting', greeting * 1e3))
+    report('poll latency', polls)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        commands, rate = bench_gateway(simulator.address, thermostats, args.commands, args.duration,
+                                       args.poll_interval, workdir)
+        report('command round-trip', commands)
+        # includes heartbeat refreshes, MQTT update interval equals the poll interval here
+        print('%-20s %8.1f msg/s' % ('published', rate))
+        print('simulator: sessions %d, polls %d, commands %d, duty cycle %.1f%%' % (
+            simulator.sessions, simulator.polls, simulator.commands, simulator.duty_cycle()))
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
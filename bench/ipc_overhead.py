@@ -0,0 +1,155 @@
+"""Compares the multiprocess and threads gateway layouts.
+
+Reports per-batch cost of passing message batches through
+multiprocessing.Queue and MessagePipeline.RingBuffer, and memory used
+by a Cube worker plus a message consumer run as processes or as threads
+of one process, both polling the local Cube simulator. Every layout is
+measured in a fresh interpreter. RSS and PSS are read from /proc, so
+memory figures are Linux only.
+
+Usage: python bench/ipc_overhead.py [--batches N] [--tasks-per-batch T] [--rooms R] [--devices-per-room D]
+                                    [--duration S]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from MaxWorker import MaxWorker
+from MessagePipeline import RingBuffer, prepare_batch
+from maxcube.simulator import CubeSimulator
+
+
+def consume(message_queue, count, done):
+    for _ in range(count):
+        message_queue.get()
+    done.put(True)
+
+
+def drain(message_queue):
+    while True:
+        message_queue.get()
+
+
+def sample_batch(tasks):
+    return prepare_batch([{'method': 'publish', 'deviceId': 'KEQ%07d' % index, 'param': 'actual_temperature',
+                           'payload': 21.5, 'qos': 0, 'timestamp': time.time()} for index in range(tasks)], 'cube')
+
+
+def bench_transfer(message_queue, done, consumer, batches, tasks):
+    batch = sample_batch(tasks)
+    consumer.start()
+    start = time.perf_counter()
+    for _ in range(batches):
+        message_queue.put(batch)
+    done.get()
+    elapsed = time.perf_counter() - start
+    consumer.join()
+    return elapsed / batches
+
+
+def memory(pid):
+    """(RSS, PSS) of the process in kB, PSS splits pages shared after fork between the processes."""
+    values = {}
+    for path in ('/proc/%d/status' % pid, '/proc/%d/smaps_rollup' % pid):
+        try:
+            with open(path) as status:
+                for line in status:
+                    key, _, value = line.partition(':')
+                    if key in ('VmRSS', 'Pss'):
+                        values[key] = int(value.split()[0])
+        except OSError:
+            pass
+    return values.get('VmRSS'), values.get('Pss')
+
+
+def run_layout(layout, address, duration):
+    """Runs one layout in this interpreter and prints its memory as JSON."""
+    config = {
+        'max_cube_ip_adress': address[0],
+        'max_cube_port': address[1],
+        'max_topology_refresh_interval': 0.5,
+        'max_mqtt_update_interval': 5,
+        'max_cube_duty_cycle_reset_interval': 3600,
+        'max_perform_sanity_check': False,
+        'max_cube_persistent_session': True,
+        'max_topology_file': os.path.join(tempfile.mkdtemp(), 'topology.json'),
+    }
+    if layout == 'threads':
+        message_queue = RingBuffer(100)
+        worker = MaxWorker(message_queue, queue.Queue(), config)
+        threading.Thread(target=worker.run, daemon=True).start()
+        threading.Thread(target=drain, args=(message_queue,), daemon=True).start()
+        pids = [os.getpid()]
+    else:
+        message_queue = multiprocessing.Queue(100)
+        worker = MaxWorker(message_queue, multiprocessing.Queue(), config)
+        worker.daemon = True
+        worker.start()
+        consumer = multiprocessing.Process(target=drain, args=(message_queue,), daemon=True)
+        consumer.start()
+        pids = [os.getpid(), worker.pid, consumer.pid]
+    time.sleep(duration)
+    samples = [memory(pid) for pid in pids]
+    if layout != 'threads':
+        # children would keep the output pipe open
+        worker.terminate()
+        consumer.terminate()
+    print(json.dumps({'processes': len(pids),
+                      'rss': sum(rss or 0 for rss, _ in samples),
+                      'pss': sum(pss or 0 for _, pss in samples)}))
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def measure_layout(layout, address, duration):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--layout', layout,
+                                      '--address', '%s:%d' % address, '--duration', str(duration)])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--batches', type=int, default=10000)
+    parser.add_argument('--tasks-per-batch', type=int, default=10)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--devices-per-room', type=int, default=5)
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds every layout polls before measuring')
+    parser.add_argument('--layout', choices=('threads', 'processes'), help=argparse.SUPPRESS)
+    parser.add_argument('--address', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.layout:
+        host, port = args.address.rsplit(':', 1)
+        run_layout(args.layout, (host, int(port)), args.duration)
+        return
+
+    message_queue, done = multiprocessing.Queue(100), multiprocessing.Queue()
+    process_cost = bench_transfer(message_queue, done, multiprocessing.Process(
+        target=consume, args=(message_queue, args.batches, done)), args.batches, args.tasks_per_batch)
+    message_queue, done = RingBuffer(100), queue.Queue()
+    ring_cost = bench_transfer(message_queue, done, threading.Thread(
+        target=consume, args=(message_queue, args.batches, done)), args.batches, args.tasks_per_batch)
+    print('batches: %d, tasks per batch: %d' % (args.batches, args.tasks_per_batch))
+    print('%-22s %8.2f us/batch' % ('multiprocessing.Queue', process_cost * 1e6))
+    print('%-22s %8.2f us/batch' % ('RingBuffer', ring_cost * 1e6))
+
+    simulator = CubeSimulator(args.rooms, args.devices_per_room, change_rate=0.3, seed=1).start()
+    print('devices: %d' % len(simulator.devices))
+    for layout in ('processes', 'threads'):
+        result = measure_layout(layout, simulator.address, args.duration)
+        print('%-10s processes %d  RSS %8.1f MB  PSS %8.1f MB' % (
+            layout, result['processes'], result['rss'] / 1024.0, result['pss'] / 1024.0))
+    simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
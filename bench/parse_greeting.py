@@ -0,0 +1,65 @@
+"""Measures MaxCube parse time of large synthetic greetings and L messages.
+
+Usage: python bench/parse_greeting.py [--rooms R] [--devices-per-room D] [--repeat N]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from maxcube.cube import MaxCube
+from maxcube.simulator import CubeSimulator
+
+
+class GreetingConnection(object):
+    """Stands in for MaxCubeConnection, serves a prepared response."""
+
+    def __init__(self, response):
+        self.response = response
+
+    def is_connected(self):
+        return False
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+def measure(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rooms', type=int, default=25)
+    parser.add_argument('--devices-per-room', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    devices = args.rooms * args.devices_per_room
+    if devices > 255:
+        parser.error('M message holds at most 255 devices')
+    greeting = CubeSimulator(args.rooms, args.devices_per_room).greeting()
+    l_message = greeting.strip().split('\r\n')[-1]
+
+    greeting_time = measure(lambda: MaxCube(GreetingConnection(greeting)), args.repeat)
+    cube = MaxCube(GreetingConnection(greeting))
+    l_time = measure(lambda: cube.parse_l_message(l_message), args.repeat)
+
+    print('devices: %d, greeting: %d bytes' % (devices, len(greeting)))
+    print('greeting parse %8.3f ms  %6.2f us/device' % (greeting_time * 1e3, greeting_time * 1e6 / devices))
+    print('L message parse %7.3f ms  %6.2f us/device' % (l_time * 1e3, l_time * 1e6 / devices))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Compares MQTT publish throughput of paho publish.single against one persistent client.
+
+Usage: python bench/publish_throughput.py [--host HOST] [--port PORT] [--count N] [--qos Q]
+Broker defaults are taken from config.json.
+"""
+import argparse
+import json
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+import paho.mqtt.publish as publish
+
+
+def bench_single(host, port, topic, count, qos):
+    start = time.time()
+    for i in range(count):
+        publish.single(topic, payload=str(i), qos=qos, hostname=host, port=port)
+    return time.time() - start
+
+
+def bench_persistent(host, port, topic, count, qos, inflight):
+    done = threading.Event()
+    acked = [0]
+
+    def on_publish(client, userdata, mid):
+        acked[0] += 1
+        if acked[0] == count:
+            done.set()
+
+    client = mqtt.Client(client_id='Max!-MQTT-bench', clean_session=True)
+    client.max_inflight_messages_set(inflight)
+    client.on_publish = on_publish
+    client.connect(host, port=port, keepalive=60)
+    client.loop_start()
+
+    start = time.time()
+    for i in range(count):
+        client.publish(topic, payload=str(i), qos=qos)
+    done.wait()
+    elapsed = time.time() - start
+
+    client.loop_stop()
+    client.disconnect()
+    return elapsed
+
+
+def main():
+    config = {}
+    try:
+        with open('config.json') as json_data:
+            config = json.load(json_data)
+    except Exception:
+        pass
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default=config.get('mqtt_host', 'localhost'))
+    parser.add_argument('--port', type=int, default=config.get('mqtt_port', 1883))
+    parser.add_argument('--topic', default=config.get('mqtt_prefix', '/data/MaxCube') + '/bench/value')
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--qos', type=int, default=1)
+    parser.add_argument('--inflight', type=int, default=config.get('mqtt_max_inflight', 20))
+    args = parser.parse_args()
+
+    for name, elapsed in (
+            ('publish.single', bench_single(args.host, args.port, args.topic, args.count, args.qos)),
+            ('persistent client', bench_persistent(args.host, args.port, args.topic, args.count, args.qos,
+                                                   args.inflight))):
+        print('%-18s %6d messages in %7.3fs  %9.1f msg/s' % (name, args.count, elapsed, args.count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import asyncio
+import contextlib
+import logging
+import time
+
+from maxcube.connection import \
+    MaxCubeConnection, \
+    GREETING_TERMINATOR, \
+    HEARTBEAT_COMMAND, \
+    QUIT_COMMAND, \
+    RESPONSE_TERMINATORS
+from maxcube.cube import MaxCube
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMaxCubeConnection(MaxCubeConnection):
+    """asyncio stream based MaxCubeConnection.
+
+    Session, backoff, response parsing and retry logic are inherited, only
+    the stream I/O is awaited. One request/response exchange runs at a time.
+    """
+
+    def __init__(self, host, port, persistent=False, heartbeat_interval=60, max_backoff=300, timeout=2):
+        MaxCubeConnection.__init__(self, host, port, persistent, heartbeat_interval, max_backoff, timeout)
+        self.stream_reader = None
+        self.stream_writer = None
+        self.lock = asyncio.Lock()
+
+    def is_connected(self):
+        return self.stream_writer is not None
+
+    async def connect(self):
+        if self.session_open():
+            return
+        self.check_backoff()
+        await self.close()
+        start = time.perf_counter()
+
+        try:
+            self.stream_reader, self.stream_writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+        except Exception:
+            self.connect_failed()
+            raise
+        self.connect_succeeded()
+        await self.read(GREETING_TERMINATOR)
+        if self.on_timing is not None:
+            self.on_timing('connect', time.perf_counter() - start)
+
+    async def read(self, terminator=None):
+        reading = self.reading(terminator)
+        try:
+            next(reading)
+            while True:
+                try:
+                    data = await asyncio.wait_for(self.stream_reader.read(4096), self.timeout)
+                except asyncio.TimeoutError:
+                    data = None
+                reading.send(data)
+        except StopIteration:
+            pass
+
+    async def send(self, command):
+        terminator = RESPONSE_TERMINATORS.get(command[:2])
+        async with self.lock:
+            try:
+                await self.exchange(command, terminator)
+            except Exception as e:
+                self.send_failed(e)
+
+            if self.session_lost(command):
+                await self.connect()
+                await self.exchange(command, terminator)
+
+    async def exchange(self, command, terminator):
+        self.stream_writer.write(command.encode('utf-8'))
+        await self.stream_writer.drain()
+        if command == QUIT_COMMAND:
+            self.response = None
+            return
+        await self.read(terminator)
+
+    async def heartbeat(self):
+        if not self.heartbeat_due():
+            return False
+        logger.debug('Sending heartbeat to Max! Cube')
+        await self.send(HEARTBEAT_COMMAND)
+        return True
+
+    async def disconnect(self):
+        if self.persistent or self.held:
+            return
+        await self.close()
+
+    @contextlib.asynccontextmanager
+    async def batch(self):
+        held = self.held
+        self.held = True
+        try:
+            yield self
+        finally:
+            self.held = held
+            await self.disconnect()
+
+    async def close(self):
+        if self.stream_writer:
+            try:
+                await self.exchange(QUIT_COMMAND, None)
+            except Exception:
+                logger.debug('Tried disconnecting from cube, caught Exception probably due to stale connection.')
+            self.drop()
+
+    def drop(self):
+        if self.stream_writer:
+            try:
+                self.stream_writer.close()
+            except Exception:
+                pass
+        self.stream_reader = None
+        self.stream_writer = None
+        self.reader.reset()
+        self.pending.clear()
+
+
+class AsyncMaxCube(MaxCube):
+    """MaxCube reusing the synchronous parsers on top of AsyncMaxCubeConnection.
+
+    Nothing is read in the constructor, use create() or await update().
+    set_* methods are inherited and return awaitables, only sending is async.
+    """
+
+    def init(self):
+        pass
+
+    @classmethod
+    async def create(cls, connection):
+        cube = cls(connection)
+        await cube.update()
+        cube.log()
+        return cube
+
+    async def update(self):
+        if self.connection.is_connected():
+            await self.connection.send(HEARTBEAT_COMMAND)
+        else:
+            await self.connection.connect()
+        self.parse_response(self.connection.response)
+        if self.metadata_stale and self.connection.is_connected():
+            await self.refetch_metadata()
+        await self.connection.disconnect()
+
+    async def refetch_metadata(self):
+        logger.info('Cube configuration changed, fetching metadata')
+        self.metadata_stale = False
+        await self.connection.close()
+        await self.connection.connect()
+        self.parse_response(self.connection.response)
+
+    async def heartbeat(self):
+        if not await self.connection.heartbeat():
+            return False
+        self.parse_response(self.connection.response)
+        if self.metadata_stale:
+            await self.refetch_metadata()
+        return True
+
+    async def send_command(self, command):
+        logger.debug('Command: %s', command)
+        await self.connection.connect()
+        await self.connection.send(command)
+        self.parse_s_response(self.connection.response)
+        await self.connection.disconnect()
+
+    async def execute(self, operation):
+        try:
+            command = next(operation)
+            while True:
+                await self.send_command(command)
+                command = operation.send(None)
+        except StopIteration as stop:
+            return stop.value
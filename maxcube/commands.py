@@ -0,0 +1,118 @@
+import base64
+import collections
+import struct
+
+from maxcube.device import \
+    MAX_DEVICE_MODE_BOOST, \
+    MAX_DEVICE_MODE_VACATION
+
+SET_TEMPERATURE = 0x40
+CONFIG_WEEK_PROFILE = 0x10
+# set with the room id of the device, as the Cube software does,
+# so the thermostats of a room stay in sync
+FLAG_GROUP = 0x04
+
+# 00, flags, command, 000000 sender, rf address, room id
+FRAME_HEADER = struct.Struct('>BBB3x')
+FRAME_PREFIX_SIZE = FRAME_HEADER.size + 4
+# temperature with mode, vacation end date and time
+VACATION_PAYLOAD = struct.Struct('>BBBB')
+# day, up to 7 (temperature, end time) pairs
+WEEK_PROFILE_PART = 7
+WEEK_PROFILE_DAYS = ('saturday', 'sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday')
+FRAME_SIZE = FRAME_PREFIX_SIZE + 1 + WEEK_PROFILE_PART * 2
+
+
+class SReply(collections.namedtuple('SReply', 'duty_cycle command_result free_mem_slots')):
+    """Decoded S: line, duty cycle in percent and free command slots of the Cube."""
+    __slots__ = ()
+
+    @property
+    def success(self):
+        return self.command_result == 0
+
+
+def parse_s_reply(response):
+    line = response.strip().rsplit('\n', 1)[-1].strip()
+    duty_cycle, command_result, free_mem_slots = line[2:].split(',')
+    return SReply(int(duty_cycle, 16), int(command_result), int(free_mem_slots, 16))
+
+
+def temperature_byte(temperature, mode):
+    return int(temperature * 2) | (mode << 6)
+
+
+class CommandEncoder(object):
+    """Builds s: commands of one Cube.
+
+    Frame prefix of every device (header, rf address and room) is computed
+    once by prepare() when the M message assigns the device, frames are
+    written into one reused buffer and only base64 encoded from there.
+    """
+
+    def __init__(self):
+        # (rf_address, command, flags) -> (room_id, prefix)
+        self.prefixes = {}
+        self.buffer = bytearray(FRAME_SIZE)
+
+    def prepare(self, device):
+        """Caches set temperature prefixes of the device, called whenever the M message is parsed."""
+        self.prefix(device, SET_TEMPERATURE, FLAG_GROUP)
+
+    def prefix(self, device, command, flags):
+        key = (device.rf_address, command, flags)
+        entry = self.prefixes.get(key)
+        if entry is None or entry[0] != device.room_id:
+            prefix = bytearray(FRAME_PREFIX_SIZE)
+            FRAME_HEADER.pack_into(prefix, 0, 0, flags, command)
+            prefix[FRAME_HEADER.size:FRAME_HEADER.size + 3] = bytes.fromhex(device.rf_address)
+            prefix[FRAME_PREFIX_SIZE - 1] = device.room_id
+            entry = self.prefixes[key] = (device.room_id, bytes(prefix))
+        return entry[1]
+
+    def forget(self, rf_address):
+        for key in [key for key in self.prefixes if key[0] == rf_address]:
+            del self.prefixes[key]
+
+    def encode(self, device, command, flags, size):
+        """Base64 frame of the prefix and size payload bytes already written into the buffer."""
+        self.buffer[:FRAME_PREFIX_SIZE] = self.prefix(device, command, flags)
+        frame = memoryview(self.buffer)[:FRAME_PREFIX_SIZE + size]
+        return 's:' + base64.b64encode(frame).decode('ascii') + '\r\n'
+
+    def set_temperature(self, device, temperature, mode):
+        self.buffer[FRAME_PREFIX_SIZE] = temperature_byte(temperature, mode)
+        return self.encode(device, SET_TEMPERATURE, FLAG_GROUP, 1)
+
+    def boost(self, device):
+        return self.set_temperature(device, device.target_temperature, MAX_DEVICE_MODE_BOOST)
+
+    def vacation(self, device, temperature, until):
+        """Holds temperature until the datetime until, rounded down to half an hour."""
+        VACATION_PAYLOAD.pack_into(self.buffer, FRAME_PREFIX_SIZE,
+                                   temperature_byte(temperature, MAX_DEVICE_MODE_VACATION),
+                                   (until.month & 0x0E) << 4 | until.day,
+                                   (until.month & 0x01) << 7 | (until.year - 2000),
+                                   until.hour * 2 + until.minute // 30)
+        return self.encode(device, SET_TEMPERATURE, FLAG_GROUP, VACATION_PAYLOAD.size)
+
+    def week_program(self, device, day, periods):
+        """Frames of one day program, periods are (end minute of day, temperature) pairs.
+
+        Up to 13 periods, the Cube takes at most 7 per frame so longer
+        programs are sent as two frames, the second marked in the day byte.
+        """
+        if len(periods) > 2 * WEEK_PROFILE_PART - 1:
+            raise ValueError('Day program holds at most %d periods' % (2 * WEEK_PROFILE_PART - 1))
+        day = WEEK_PROFILE_DAYS.index(day) if isinstance(day, str) else day
+        commands = []
+        for part in range(0, max(1, len(periods)), WEEK_PROFILE_PART):
+            chunk = periods[part:part + WEEK_PROFILE_PART]
+            self.buffer[FRAME_PREFIX_SIZE] = day | (0x10 if part else 0)
+            pos = FRAME_PREFIX_SIZE + 1
+            for end, temperature in chunk:
+                # temperature in half degrees, end time in 5 minute steps
+                struct.pack_into('>H', self.buffer, pos, int(temperature * 2) << 9 | end // 5)
+                pos += 2
+            commands.append(self.encode(device, CONFIG_WEEK_PROFILE, 0, 1 + len(chunk) * 2))
+        return commands
@@ -1,52 +1,232 @@
+import collections
+import contextlib
 import logging
 import socket
+import time
 
 logger = logging.getLogger(__name__)
 
+HEARTBEAT_COMMAND = 'l:\r\n'
+QUIT_COMMAND = 'q:\r\n'
+
+# message type closing the Cube answer to a command, None when the Cube does not answer
+GREETING_TERMINATOR = 'L:'
+RESPONSE_TERMINATORS = {
+    'l:': 'L:',
+    's:': 'S:',
+    'q:': None,
+}
+
+
+class MaxCubeLineReader(object):
+    """Incremental parser splitting the Cube stream into CRLF terminated lines."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Adds received bytes and returns the list of lines completed by them."""
+        self.buffer += data
+        lines = []
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', start)
+            if end < 0:
+                break
+            line = self.buffer[start:end].rstrip(b'\r')
+            if line:
+                lines.append(line.decode('utf-8'))
+            start = end + 1
+        del self.buffer[:start]
+        return lines
+
+    def reset(self):
+        self.buffer = bytearray()
+
 
 class MaxCubeConnection(object):
-    def __init__(self, host, port):
+    def __init__(self, host, port, persistent=False, heartbeat_interval=60, max_backoff=300, timeout=2):
         self.host = host
         self.port = port
+        self.timeout = timeout
         self.socket = None
         self.response = None
+        self.reader = MaxCubeLineReader()
+        self.pending = collections.deque()
+
+        # in persistent mode one socket is kept open and shared by polling and commands
+        self.persistent = persistent
+        # set while a batch of operations shares one session
+        self.held = False
+        self.heartbeat_interval = heartbeat_interval
+        self.max_backoff = max_backoff
+        self.last_activity = 0
+        self.backoff = 0
+        self.next_attempt = 0
+        # optional callback(operation, seconds) timing 'connect' and 'read', e.g. for metrics
+        self.on_timing = None
+
+    def is_connected(self):
+        return self.socket is not None
+
+    def session_open(self):
+        return (self.persistent or self.held) and self.is_connected()
+
+    def check_backoff(self):
+        if time.time() < self.next_attempt:
+            raise ConnectionError('Reconnecting to Max! Cube postponed for %.0fs' % (self.next_attempt - time.time()))
+        logger.debug('Connecting to Max! Cube at %s:%s', self.host, self.port)
+
+    def connect_failed(self):
+        self.drop()
+        self.backoff = min(max(1, self.backoff * 2), self.max_backoff)
+        self.next_attempt = time.time() + self.backoff
+
+    def connect_succeeded(self):
+        self.backoff = 0
+        self.next_attempt = 0
 
     def connect(self):
-        logger.debug('Connecting to Max! Cube at ' + self.host + ':' + str(self.port))
+        if self.session_open():
+            return
+        self.check_backoff()
+        self.close()
+        start = time.perf_counter()
 
-        self.disconnect()
+        try:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.settimeout(self.timeout)
+            self.socket.connect((self.host, self.port))
+        except Exception:
+            self.connect_failed()
+            raise
+        self.connect_succeeded()
+        self.read(GREETING_TERMINATOR)
+        if self.on_timing is not None:
+            self.on_timing('connect', time.perf_counter() - start)
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.settimeout(2)
-        self.socket.connect((self.host, self.port))
-        self.read()
+    def reading(self, terminator=None):
+        """Collects response lines into self.response.
 
-    def read(self):
-        buffer_size = 4096
-        buffer = bytearray([])
-        more = True
+        Generator returning as soon as a line starting with terminator
+        arrives. Whenever it needs more data it yields and expects the
+        received bytes to be sent in, None on timeout, which is only a
+        safety net. read() feeds it from the socket, the asyncio
+        connection from its stream.
+        """
+        lines = []
+        start = time.perf_counter()
 
-        while more:
-            try:
-                tmp = self.socket.recv(buffer_size)
-                more = len(tmp) > 0
-                buffer += tmp
-            except socket.timeout:
+        while True:
+            if self.pending:
+                line = self.pending.popleft()
+                lines.append(line)
+                if terminator is not None and line.startswith(terminator):
+                    break
+                continue
+            data = yield
+            if data is None:
+                if terminator is not None:
+                    logger.warning('Timeout while waiting for %s message', terminator)
                 break
-        self.response = buffer.decode('utf-8')
+            if not data:
+                # peer closed the session
+                self.drop()
+                break
+            self.pending.extend(self.reader.feed(data))
+        self.last_activity = time.time()
+        self.response = '\r\n'.join(lines)
+        if self.on_timing is not None:
+            self.on_timing('read', time.perf_counter() - start)
+
+    def read(self, terminator=None):
+        reading = self.reading(terminator)
+        try:
+            next(reading)
+            while True:
+                try:
+                    data = self.socket.recv(4096)
+                except socket.timeout:
+                    data = None
+                reading.send(data)
+        except StopIteration:
+            pass
 
     def send(self, command):
+        terminator = RESPONSE_TERMINATORS.get(command[:2])
         try:
-            self.socket.send(command.encode('utf-8'))
-            self.read()
+            self.exchange(command, terminator)
         except Exception as e:
-            logger.error('Problem during send: %s' % e)
+            self.send_failed(e)
+
+        if self.session_lost(command):
+            self.connect()
+            self.exchange(command, terminator)
+
+    def exchange(self, command, terminator):
+        self.socket.send(command.encode('utf-8'))
+        if command == QUIT_COMMAND:
+            self.response = None
+            return
+        self.read(terminator)
+
+    def send_failed(self, e):
+        logger.error('Problem during send: %s', e)
+        self.drop()
+        self.response = ''
+
+    def session_lost(self, command):
+        if self.persistent and not self.response and command != QUIT_COMMAND:
+            # stale session, reconnect once and repeat the command
+            logger.info('Max! Cube session lost, reconnecting')
+            return True
+        return False
+
+    def heartbeat_due(self):
+        return self.persistent and self.is_connected() and time.time() >= self.last_activity + self.heartbeat_interval
+
+    def next_heartbeat(self):
+        if not self.persistent or not self.is_connected():
+            return None
+        return self.last_activity + self.heartbeat_interval
+
+    def heartbeat(self):
+        if not self.heartbeat_due():
+            return False
+        logger.debug('Sending heartbeat to Max! Cube')
+        self.send(HEARTBEAT_COMMAND)
+        return True
 
     def disconnect(self):
+        if self.persistent or self.held:
+            return
+        self.close()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Keeps one session open for all operations in the block."""
+        held = self.held
+        self.held = True
+        try:
+            yield self
+        finally:
+            self.held = held
+            self.disconnect()
+
+    def close(self):
         if self.socket:
             try:
-                self.send('q:\r\n')
-                self.socket.close()
+                self.send(QUIT_COMMAND)
             except:
                 logger.debug('Tried disconnecting from cube, caught Exception probably due to stale connection.')
+            self.drop()
+
+    def drop(self):
+        if self.socket:
+            try:
+                self.socket.close()
+            except:
+                pass
             self.socket = None
+        self.reader.reset()
+        self.pending.clear()
@@ -1,19 +1,88 @@
 import base64
+import collections
 import logging
 import struct
+import time
 
+from maxcube.commands import CommandEncoder, parse_s_reply
+from maxcube.connection import HEARTBEAT_COMMAND
 from maxcube.device import \
     MaxDevice, \
     MAX_CUBE, \
     MAX_THERMOSTAT, \
     MAX_THERMOSTAT_PLUS, \
     MAX_WALL_THERMOSTAT, \
+    MAX_WINDOW_SHUTTER, \
+    MAX_PUSH_BUTTON, \
     MAX_DEVICE_MODE_AUTOMATIC, \
-    MAX_DEVICE_MODE_MANUAL
+    MAX_DEVICE_MODE_MANUAL, \
+    MAX_DEVICE_MODE_VACATION
+from maxcube.ecobutton import MaxEcoButton
+from maxcube.registry import MaxDeviceRegistry
 from maxcube.thermostat import MaxThermostat
+from maxcube.windowshutter import MaxWindowShutter
 
 logger = logging.getLogger(__name__)
 
+# precompiled layouts, rf address is read together with a neighbouring byte as a big endian int
+M_ROOM_HEADER = struct.Struct('>BB')
+M_DEVICE_HEADER = struct.Struct('>I10sB')
+L_HEADER = struct.Struct('>BIBB')
+L_THERMOSTAT = struct.Struct('>BBHB')
+L_WALL_THERMOSTAT = struct.Struct('>BBHBB')
+
+_rf_address_strings = {}
+
+
+def format_rf_address(rf):
+    address = _rf_address_strings.get(rf)
+    if address is None:
+        address = _rf_address_strings[rf] = '%06X' % rf
+    return address
+
+
+def decode_thermostat(device, flags2, values):
+    valve_position, target, temperature, _ = values
+    device.mode = flags2 & 0x03
+    device.valve_position = valve_position
+    device.target_temperature = (target & 0x7F) / 2.0
+    # in vacation and boost mode the temperature bytes hold the end date
+    if device.mode == MAX_DEVICE_MODE_MANUAL or device.mode == MAX_DEVICE_MODE_AUTOMATIC:
+        if temperature:
+            device.actual_temperature = temperature / 10.0
+
+
+def decode_wall_thermostat(device, flags2, values):
+    _, target, _, _, actual = values
+    device.mode = flags2 & 0x03
+    device.target_temperature = (target & 0x7F) / 2.0
+    # highest bit of the target byte is the ninth bit of the actual temperature
+    actual_temperature = (actual + (target & 0x80) * 2) / 10.0
+    if actual_temperature:
+        device.actual_temperature = actual_temperature
+
+
+def decode_window_shutter(device, flags2, values):
+    device.is_open = flags2 & 0x03 == 0x02
+
+
+def decode_eco_button(device, flags2, values):
+    pass
+
+
+# Layout of one device type in M and L messages: device class created for
+# M entries, struct of the L submessage body following L_HEADER (None when
+# the header carries all values) and decoder applying the unpacked values.
+DeviceLayout = collections.namedtuple('DeviceLayout', 'device_class l_body decode')
+
+DEVICE_LAYOUTS = {
+    MAX_THERMOSTAT: DeviceLayout(MaxThermostat, L_THERMOSTAT, decode_thermostat),
+    MAX_THERMOSTAT_PLUS: DeviceLayout(MaxThermostat, L_THERMOSTAT, decode_thermostat),
+    MAX_WALL_THERMOSTAT: DeviceLayout(MaxThermostat, L_WALL_THERMOSTAT, decode_wall_thermostat),
+    MAX_WINDOW_SHUTTER: DeviceLayout(MaxWindowShutter, None, decode_window_shutter),
+    MAX_PUSH_BUTTON: DeviceLayout(MaxEcoButton, None, decode_eco_button),
+}
+
 
 class MaxCube(MaxDevice):
     def __init__(self, connection):
@@ -22,12 +91,28 @@ class MaxCube(MaxDevice):
         self.name = 'Cube'
         self.type = MAX_CUBE
         self.firmware_version = None
-        self.devices = []
+        self.devices = MaxDeviceRegistry()
+        self.encoder = CommandEncoder()
 
         self.duty_cycle = None
         self.command_result = None
         self.command_success = None
         self.free_mem_slots = None
+        # time of the last duty cycle report (greeting or S: reply)
+        self.duty_cycle_timestamp = None
+
+        # devices with dirty fields, collected since last pop_changed_devices()
+        self.changed_devices = set()
+        # serials of devices unpaired since last pop_removed_devices()
+        self.removed_devices = set()
+        # set when L message references a device unknown from M message
+        self.metadata_stale = False
+        self.known_rf_addresses = set()
+        # last raw M and C lines, identical lines are not decoded again
+        self._metadata = {}
+        # optional callback(operation, seconds) timing parse of every message type, e.g. 'parse:L',
+        # shared with the connection so the greeting parsed by the constructor is timed too
+        self.on_timing = getattr(connection, 'on_timing', None)
 
         self.init()
 
@@ -48,7 +133,11 @@ class MaxCube(MaxDevice):
                 logger.info('Device (rf=%s, name=%s' % (device.rf_address, device.name))
 
     def update(self):
-        self.connection.connect()
+        if self.connection.is_connected():
+            # persistent session, the greeting was already consumed so only poll live values
+            self.connection.send(HEARTBEAT_COMMAND)
+        else:
+            self.connection.connect()
         response = self.connection.response
 
         # FIXME veriy response and calculate params
@@ -60,182 +149,273 @@ class MaxCube(MaxDevice):
         # self.command_success = self.command_result == 0
 
         self.parse_response(response)
+        if self.metadata_stale and self.connection.is_connected():
+            self.refetch_metadata()
         self.connection.disconnect()
 
+    def refetch_metadata(self):
+        # M and C messages are sent only in the greeting, so a new session is needed
+        logger.info('Cube configuration changed, fetching metadata')
+        self.metadata_stale = False
+        self.connection.close()
+        self.connection.connect()
+        self.parse_response(self.connection.response)
+
+    def pop_changed_devices(self):
+        changed = self.changed_devices
+        self.changed_devices = set()
+        return changed
+
+    def pop_removed_devices(self):
+        removed = self.removed_devices
+        self.removed_devices = set()
+        return removed
+
     def get_devices(self):
         return self.devices
 
     def device_by_rf(self, rf):
-        for device in self.devices:
-            if device.rf_address == rf:
-                return device
-        return None
+        return self.devices.by_rf(rf)
+
+    def device_by_serial(self, serial):
+        return self.devices.by_serial(serial)
+
+    def devices_by_room(self, room_id):
+        return self.devices.by_room(room_id)
+
+    def room_thermostats(self, room_id):
+        return [device for device in self.devices_by_room(room_id) if self.is_thermostat(device)]
 
     def parse_response(self, response):
 
         lines = response.split('\n')
+        on_timing = self.on_timing
 
         for line in lines:
             line = line.strip()
             if line and len(line) > 10:
-                if line[:1] == 'C':
-                    self.parse_c_message(line.strip())
-                elif line[:1] == 'H':
-                    self.parse_h_message(line.strip())
-                elif line[:1] == 'L':
-                    self.parse_l_message(line.strip())
-                elif line[:1] == 'M':
-                    self.parse_m_message(line.strip())
+                key = None
+                if line[:1] == 'C' or line[:1] == 'M':
+                    key = line[:line.find(',')]
+                    if self._metadata.get(key) == line:
+                        continue
+                start = time.perf_counter() if on_timing is not None else 0
+                try:
+                    if line[:1] == 'C':
+                        self.parse_c_message(line)
+                    elif line[:1] == 'H':
+                        self.parse_h_message(line)
+                    elif line[:1] == 'L':
+                        self.parse_l_message(line)
+                    elif line[:1] == 'M':
+                        self.parse_m_message(line)
+                except Exception:
+                    # a line that failed to parse is decoded again when it is repeated
+                    if key is not None:
+                        self._metadata.pop(key, None)
+                    raise
+                if key is not None:
+                    self._metadata[key] = line
+                if on_timing is not None:
+                    on_timing('parse:' + line[:1], time.perf_counter() - start)
 
     def parse_c_message(self, message):
-        logger.debug('Parsing c_message: ' + message)
-        device_rf_address = message[1:].split(',')[0][1:].upper()
-        data = bytearray(base64.b64decode(message[2:].split(',')[1]))
-        device = self.device_by_rf(device_rf_address)
+        logger.debug('Parsing c_message: %s', message)
+        separator = message.index(',', 2)
+        device = self.device_by_rf(message[2:separator].upper())
 
         if device and self.is_thermostat(device):
+            data = base64.b64decode(message[separator + 1:])
             device.min_temperature = data[21] / 2.0
             device.max_temperature = data[20] / 2.0
 
     def parse_h_message(self, message):
-        logger.debug('Parsing h_message: ' + message)
+        logger.debug('Parsing h_message: %s', message)
         tokens = message[2:].split(',')
         self.rf_address = tokens[1]
         self.firmware_version = (tokens[2][0:2]) + '.' + (tokens[2][2:4])
+        if len(tokens) > 6:
+            self.duty_cycle = int(tokens[5], 16)
+            self.free_mem_slots = int(tokens[6], 16)
+            self.duty_cycle_timestamp = time.time()
 
     def parse_m_message(self, message):
-        logger.debug('Parsing m_message: ' + message)
-        data = bytearray(base64.b64decode(message[2:].split(',')[2]))
+        logger.debug('Parsing m_message: %s', message)
+        data = memoryview(base64.b64decode(message[2:].split(',')[2]))
         num_rooms = data[2]
         rooms = {}
         pos = 3
         for _ in range(0, num_rooms):
-            room_id = struct.unpack('bb', data[pos:pos + 2])[0]
-            name_length = struct.unpack('bb', data[pos:pos + 2])[1]
-            pos += 1 + 1
-            name = data[pos:pos + name_length].decode('utf-8')
-            rooms[room_id] = name
-            pos += name_length
-            device_rf_address = self.parse_rf_address(data[pos: pos + 3])
-            pos += 3
+            room_id, name_length = M_ROOM_HEADER.unpack_from(data, pos)
+            pos += M_ROOM_HEADER.size
+            rooms[room_id] = str(data[pos:pos + name_length], 'utf-8')
+            # room name is followed by rf address of the group
+            pos += name_length + 3
 
         num_devices = data[pos]
         pos += 1
+        seen = set()
+        known = set()
 
         for device_idx in range(0, num_devices):
-            device_type = data[pos]
-            device_rf_address = self.parse_rf_address(data[pos + 1: pos + 1 + 3])
-            device_serial = data[pos + 4:pos + 14].decode('utf-8')
-            device_name_length = data[pos + 14]
-            device_name = data[pos + 15:pos + 15 + device_name_length].decode('utf-8')
-            room_id = data[pos + 15 + device_name_length]
+            type_rf, device_serial, device_name_length = M_DEVICE_HEADER.unpack_from(data, pos)
+            pos += M_DEVICE_HEADER.size
+            device_type = type_rf >> 24
+            device_rf_address = format_rf_address(type_rf & 0xFFFFFF)
+            device_name = str(data[pos:pos + device_name_length], 'utf-8')
+            room_id = data[pos + device_name_length]
+            pos += device_name_length + 1
+            known.add(device_rf_address)
             device = self.device_by_rf(device_rf_address)
 
-            if not device:
-                if device_type == MAX_THERMOSTAT or device_type == MAX_THERMOSTAT_PLUS or device_type == MAX_WALL_THERMOSTAT:
-                    device = MaxThermostat()
+            layout = DEVICE_LAYOUTS.get(device_type)
+            if device and (layout is None or type(device) is not layout.device_class):
+                # device was re-paired as a different type
+                self.devices.remove(device)
+                device = None
 
-                if device:
-                    self.devices.append(device)
+            if not device and layout is not None:
+                device = layout.device_class()
+                self.devices.add(device)
 
             if device:
                 device.type = device_type
                 device.rf_address = device_rf_address
                 device.room_id = room_id
-                device.room_name = rooms[room_id]
+                # room 0 holds house wide devices like the eco button, it is no room
+                device.room_name = rooms.get(room_id)
                 device.name = device_name
-                device.serial = device_serial
-
-            pos += 1 + 3 + 10 + device_name_length + 2
+                device.serial = device_serial.decode('utf-8')
+                self.devices.reindex(device)
+                self.encoder.prepare(device)
+                if device.dirty:
+                    self.changed_devices.add(device)
+                seen.add(device_rf_address)
+
+        # devices unpaired since the previous M message
+        for device in self.devices:
+            if device.rf_address not in seen:
+                self.encoder.forget(device.rf_address)
+                self.removed_devices.add(device.serial)
+        self.devices.retain(seen)
+        self.changed_devices &= set(self.devices)
+        self.known_rf_addresses = known
+        self.metadata_stale = False
 
     def parse_l_message(self, message):
-        logger.debug('Parsing l_message: ' + message)
-        data = bytearray(base64.b64decode(message[2:]))
+        logger.debug('Parsing l_message: %s', message)
+        data = base64.b64decode(message[2:])
+        size = len(data)
         pos = 0
 
-        while pos < len(data):
-            length = data[pos]
-            pos += 1
-            device_rf_address = self.parse_rf_address(data[pos: pos + 3])
+        while pos + L_HEADER.size <= size:
+            length, rf, flags1, flags2 = L_HEADER.unpack_from(data, pos)
+            end = pos + length + 1
+            device_rf_address = format_rf_address(rf >> 8)
 
             device = self.device_by_rf(device_rf_address)
-
-            if device and self.is_thermostat(device):
-                device.rf_address = device_rf_address
-                bits1, bits2 = struct.unpack('BB', bytearray(data[pos + 4:pos + 6]))
-
-                submessage_len, rf1, rf2, rf3, unknown, flags1, flags2 = struct.unpack('B3BBBB', bytearray(data[:7]))
-                device.link_ok = bool(flags2 & 0x07)
-                device.battery_ok = bool(flags2 & 0x08)
-
-                device.mode = self.resolve_device_mode(bits2)
-
-                actual_temperature = None
-                if device.type == MAX_WALL_THERMOSTAT:
-                    actual_temperature = ((data[pos + 11] & 0xFF) + (data[pos + 7] & 0x80) * 2) / 10.0
-                else:
-                    device.valve_position = data[pos + 6] & 0xFF
-                    if device.mode == MAX_DEVICE_MODE_MANUAL or device.mode == MAX_DEVICE_MODE_AUTOMATIC:
-                        actual_temperature = ((data[pos + 8] & 0xFF) * 256 + (data[pos + 9] & 0xFF)) / 10.0
-                if actual_temperature != 0:
-                    device.actual_temperature = actual_temperature
-                device.target_temperature = (data[pos + 7] & 0x7F) / 2.0
-            pos += length
-
-    def set_target_temperature(self, thermostat, temperature):
-        logger.debug('Setting temperature for %s to %s!' % (thermostat.rf_address, temperature))
-        rf_address = thermostat.rf_address
-        room = str(thermostat.room_id)
-        if thermostat.room_id < 10:
-            room = '0' + room
-        target_temperature = int(temperature * 2) + (thermostat.mode << 6)
-
-        byte_cmd = '000440000000' + rf_address + room + hex(target_temperature)[2:]
-        logger.debug('Request: ' + byte_cmd)
-        command = 's:' + base64.b64encode(bytearray.fromhex(byte_cmd)).decode('utf-8') + '\r\n'
-        logger.debug('Command: ' + command)
-
+            if device is None:
+                if device_rf_address not in self.known_rf_addresses:
+                    self.metadata_stale = True
+                pos = end
+                continue
+
+            layout = DEVICE_LAYOUTS[device.type]
+            body = layout.l_body
+            values = None
+            if body is not None:
+                if end < pos + L_HEADER.size + body.size:
+                    # truncated submessage, e.g. device not yet reachable after pairing
+                    pos = end
+                    continue
+                values = body.unpack_from(data, pos + L_HEADER.size)
+
+            device.link_ok = not flags2 & 0x40
+            device.battery_ok = not flags2 & 0x80
+            layout.decode(device, flags2, values)
+            if device.dirty:
+                self.changed_devices.add(device)
+            pos = end
+
+    def send_command(self, command):
+        logger.debug('Command: %s', command)
         self.connection.connect()
         self.connection.send(command)
-        logger.debug('Response: ' + self.connection.response)
+        self.parse_s_response(self.connection.response)
+        self.connection.disconnect()
 
-        self.duty_cycle, self.command_result, self.free_mem_slots = self.connection.response[2:].split(',')
+    def execute(self, operation):
+        """Sends every command yielded by the operation generator, returns its result.
 
-        self.duty_cycle = int(self.duty_cycle, 16)
-        self.free_mem_slots = int(self.free_mem_slots, 16)
-        self.command_result = int(self.command_result)
-        self.command_success = self.command_result == 0
+        Operations build commands with the encoder and update device state
+        once a command is sent, AsyncMaxCube only replaces the sending.
+        """
+        try:
+            command = next(operation)
+            while True:
+                self.send_command(command)
+                command = operation.send(None)
+        except StopIteration as stop:
+            return stop.value
 
-        self.connection.disconnect()
-        thermostat.target_temperature = int(temperature * 2) / 2.0
+    def set_target_temperature(self, thermostat, temperature):
+        return self.execute(self.target_temperature_operation(thermostat, temperature))
+
+    def set_room_target_temperature(self, room_id, temperature):
+        """Sets all thermostats of the room with one group frame, returns the thermostats."""
+        return self.execute(self.room_target_temperature_operation(room_id, temperature))
 
     def set_mode(self, thermostat, mode):
-        mode = int(mode)
-        logger.debug('Setting temperature for %s to %s!' % (thermostat.rf_address, mode))
-        rf_address = thermostat.rf_address
-        room = str(thermostat.room_id)
-        if thermostat.room_id < 10:
-            room = '0' + room
-        target_temperature = int(thermostat.target_temperature * 2) + (mode << 6)
-        byte_cmd = '000440000000' + rf_address + room + hex(target_temperature)[2:]
-        logger.debug('Request: ' + byte_cmd)
-        command = 's:' + base64.b64encode(bytearray.fromhex(byte_cmd)).decode('utf-8') + '\r\n'
-        logger.debug('Command: ' + command)
+        return self.execute(self.mode_operation(thermostat, mode))
 
-        self.connection.connect()
-        self.connection.send(command)
-        logger.debug('Response: ' + self.connection.response)
+    def set_vacation(self, thermostat, temperature, until):
+        return self.execute(self.vacation_operation(thermostat, temperature, until))
 
-        self.duty_cycle, self.command_result, self.free_mem_slots = self.connection.response[2:].split(',')
+    def set_week_program(self, thermostat, day, periods):
+        return self.execute(self.week_program_operation(thermostat, day, periods))
 
-        self.duty_cycle = int(self.duty_cycle, 16)
-        self.free_mem_slots = int(self.free_mem_slots, 16)
-        self.command_result = int(self.command_result)
-        self.command_success = self.command_result == 0
+    def target_temperature_operation(self, thermostat, temperature):
+        logger.debug('Setting temperature for %s to %s!', thermostat.rf_address, temperature)
+        yield self.encoder.set_temperature(thermostat, temperature, thermostat.mode)
+        thermostat.target_temperature = int(temperature * 2) / 2.0
 
-        self.connection.disconnect()
+    def room_target_temperature_operation(self, room_id, temperature):
+        thermostats = self.room_thermostats(room_id)
+        if not thermostats:
+            return thermostats
+        logger.debug('Setting temperature for room %s to %s!', room_id, temperature)
+        yield self.encoder.set_temperature(thermostats[0], temperature, thermostats[0].mode)
+        for thermostat in thermostats:
+            thermostat.target_temperature = int(temperature * 2) / 2.0
+        return thermostats
+
+    def mode_operation(self, thermostat, mode):
+        mode = int(mode)
+        logger.debug('Setting mode for %s to %s!', thermostat.rf_address, mode)
+        yield self.encoder.set_temperature(thermostat, thermostat.target_temperature, mode)
         thermostat.mode = mode
 
+    def vacation_operation(self, thermostat, temperature, until):
+        logger.debug('Setting vacation for %s to %s until %s!', thermostat.rf_address, temperature, until)
+        yield self.encoder.vacation(thermostat, temperature, until)
+        thermostat.target_temperature = int(temperature * 2) / 2.0
+        thermostat.mode = MAX_DEVICE_MODE_VACATION
+
+    def week_program_operation(self, thermostat, day, periods):
+        logger.debug('Setting %s program for %s!', day, thermostat.rf_address)
+        for command in self.encoder.week_program(thermostat, day, periods):
+            yield command
+            if not self.command_success:
+                break
+
+    def parse_s_response(self, response):
+        logger.debug('Response: %s', response)
+        reply = parse_s_reply(response)
+        self.duty_cycle, self.command_result, self.free_mem_slots = reply
+        self.command_success = reply.success
+        self.duty_cycle_timestamp = time.time()
+        return reply
+
     @classmethod
     def resolve_device_mode(cls, bits):
         return (bits & 3)
@@ -246,4 +426,4 @@ class MaxCube(MaxDevice):
 
     @classmethod
     def parse_rf_address(cls, address):
-        return ''.join('{:02X}'.format(x) for x in address)
+        return format_rf_address(int.from_bytes(address, 'big'))
@@ -12,15 +12,37 @@ MAX_DEVICE_MODE_BOOST = 3
 
 
 class MaxDevice(object):
+    """Base of all Max! devices.
+
+    Fields live in __slots__. Assigning a new value to a field listed in
+    fields records its name in dirty, so consumers can ask which fields
+    changed instead of comparing whole device state.
+    """
+    __slots__ = ('dirty', 'type', 'rf_address', 'serial', 'room_id', 'name', 'battery_ok', 'link_ok', 'room_name')
+    fields = frozenset(__slots__[1:])
+
     def __init__(self):
+        object.__setattr__(self, 'dirty', set())
         self.type = None
         self.rf_address = None
+        self.serial = None
         self.room_id = None
         self.name = None
         self.battery_ok = None
         self.link_ok = None
         self.room_name = None
 
+    def __setattr__(self, name, value):
+        if name in self.fields and getattr(self, name, None) != value:
+            self.dirty.add(name)
+        object.__setattr__(self, name, value)
+
+    def pop_dirty(self):
+        """Returns names of fields changed since previous call."""
+        dirty = self.dirty
+        object.__setattr__(self, 'dirty', set())
+        return dirty
+
     def device_type_name(self):
         device_type_names = (
             'Cube', 'Thermostat', 'Thermostat Plus', 'Wall Thermostat', 'Shutter contact', 'Eco button'
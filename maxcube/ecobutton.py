@@ -0,0 +1,8 @@
+from maxcube.device import MaxDevice
+
+
+class MaxEcoButton(MaxDevice):
+    __slots__ = ()
+
+    def __init__(self):
+        super(MaxEcoButton, self).__init__()
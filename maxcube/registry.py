@@ -0,0 +1,81 @@
+class MaxDeviceRegistry(object):
+    """Devices of one Cube indexed by rf address, serial and room.
+
+    Iterates in pairing order like the plain list it replaces. Indexes are
+    kept up to date by reindex() whenever a parser changes the indexed fields.
+    """
+
+    def __init__(self):
+        self._devices = []
+        self._by_rf = {}
+        self._by_serial = {}
+        self._by_room = {}
+        # device -> (rf_address, serial, room_id) it is currently indexed under
+        self._keys = {}
+
+    def __iter__(self):
+        return iter(self._devices)
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __getitem__(self, index):
+        return self._devices[index]
+
+    def __contains__(self, device):
+        return device in self._keys
+
+    def add(self, device):
+        self._devices.append(device)
+        self._keys[device] = (None, None, None)
+        self.reindex(device)
+
+    def remove(self, device):
+        rf_address, serial, room_id = self._keys.pop(device)
+        self._devices.remove(device)
+        self._unindex(device, rf_address, serial, room_id)
+
+    def reindex(self, device):
+        old = self._keys[device]
+        new = (device.rf_address, getattr(device, 'serial', None), device.room_id)
+        if old == new:
+            return
+        self._unindex(device, *old)
+        rf_address, serial, room_id = new
+        if rf_address is not None:
+            self._by_rf[rf_address] = device
+        if serial is not None:
+            self._by_serial[serial] = device
+        # room 0 means no room, e.g. the eco button
+        if room_id:
+            self._by_room.setdefault(room_id, []).append(device)
+        self._keys[device] = new
+
+    def retain(self, rf_addresses):
+        """Removes devices not listed in rf_addresses, e.g. unpaired since last M message."""
+        for device in [d for d in self._devices if d.rf_address not in rf_addresses]:
+            self.remove(device)
+
+    def by_rf(self, rf_address):
+        return self._by_rf.get(rf_address)
+
+    def by_serial(self, serial):
+        return self._by_serial.get(serial)
+
+    def by_room(self, room_id):
+        return self._by_room.get(room_id, [])
+
+    def rooms(self):
+        return self._by_room.keys()
+
+    def _unindex(self, device, rf_address, serial, room_id):
+        if rf_address is not None and self._by_rf.get(rf_address) is device:
+            del self._by_rf[rf_address]
+        if serial is not None and self._by_serial.get(serial) is device:
+            del self._by_serial[serial]
+        if room_id and room_id in self._by_room:
+            room = self._by_room[room_id]
+            if device in room:
+                room.remove(device)
+            if not room:
+                del self._by_room[room_id]
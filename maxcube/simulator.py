@@ -0,0 +1,273 @@
+"""Local Max! Cube emulator for tests and benchmarks without hardware.
+
+Usage: python -m maxcube.simulator [--port P] [--rooms R] [--devices-per-room D] [--latency S] [--drop-rate X]
+"""
+import argparse
+import base64
+import logging
+import random
+import socketserver
+import threading
+import time
+
+from maxcube.device import \
+    MAX_PUSH_BUTTON, \
+    MAX_THERMOSTAT, \
+    MAX_WALL_THERMOSTAT, \
+    MAX_WINDOW_SHUTTER
+
+logger = logging.getLogger(__name__)
+
+CUBE_SERIAL = 'KEQ0000000'
+CUBE_RF_ADDRESS = '0a0b0c'
+
+
+def rf_address(index):
+    return (0x100000 + index).to_bytes(3, 'big')
+
+
+class SimulatedDevice(object):
+    __slots__ = ('type', 'rf', 'serial', 'name', 'room_id', 'mode', 'target', 'actual', 'valve', 'is_open')
+
+    def __init__(self, device_type, index, room_id):
+        self.type = device_type
+        self.rf = rf_address(index)
+        self.serial = 'KEQ%07d' % index
+        self.name = 'Device %d' % index
+        self.room_id = room_id
+        self.mode = 0
+        self.target = 42
+        self.actual = 200 + index % 50
+        self.valve = index % 100
+        self.is_open = False
+
+    def l_submessage(self):
+        flags2 = 0x18 | self.mode
+        if self.type == MAX_WINDOW_SHUTTER:
+            return bytes([6]) + self.rf + bytes([0, 0x12, 0x1A if self.is_open else 0x18])
+        if self.type == MAX_PUSH_BUTTON:
+            return bytes([6]) + self.rf + bytes([0, 0x12, 0x18])
+        if self.type == MAX_WALL_THERMOSTAT:
+            return bytes([12]) + self.rf + bytes([0, 0x12, flags2, 0, self.target | (self.actual >> 1 & 0x80), 0, 0, 0,
+                                                 self.actual & 0xFF])
+        return bytes([11]) + self.rf + bytes([0, 0x12, flags2, self.valve, self.target]) + \
+            self.actual.to_bytes(2, 'big') + bytes([0])
+
+
+class CubeSimulator(object):
+    """Serves the Cube protocol on a local TCP port.
+
+    Every room has a wall thermostat, radiator thermostats and optionally
+    a window shutter contact, the optional eco button sits in room 0 like
+    on a real Cube. Each accepted s: command costs command_cost percent of
+    the duty cycle budget, which recovers linearly over
+    duty_cycle_window seconds like on the real Cube. latency delays every
+    response, drop_rate is the probability a request closes the session
+    instead of being answered and change_rate the probability an actual
+    temperature changes between two L messages.
+    """
+
+    def __init__(self, rooms=2, devices_per_room=3, shutters=False, host='127.0.0.1', port=0, latency=0.0,
+                 drop_rate=0.0, change_rate=0.0, command_cost=1.0, duty_cycle_window=3600, free_mem_slots=50,
+                 seed=None, eco_button=False):
+        self.rooms = rooms
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.change_rate = change_rate
+        self.command_cost = command_cost
+        self.duty_cycle_window = duty_cycle_window
+        self.free_mem_slots = free_mem_slots
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.devices = []
+        index = 1
+        for room_id in range(1, rooms + 1):
+            for position in range(devices_per_room):
+                device_type = MAX_WALL_THERMOSTAT if position == 0 else MAX_THERMOSTAT
+                self.devices.append(SimulatedDevice(device_type, index, room_id))
+                index += 1
+            if shutters:
+                self.devices.append(SimulatedDevice(MAX_WINDOW_SHUTTER, index, room_id))
+                index += 1
+        if eco_button:
+            self.devices.append(SimulatedDevice(MAX_PUSH_BUTTON, index, 0))
+        if len(self.devices) > 255:
+            raise ValueError('M message holds at most 255 devices')
+        self.by_rf = {device.rf: device for device in self.devices}
+
+        self.duty_cycle_used = 0.0
+        self.duty_cycle_updated = time.time()
+        self.commands = 0
+        self.polls = 0
+        self.sessions = 0
+
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def bind(self):
+        simulator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                simulator.handle(self.request)
+
+        self.server = socketserver.ThreadingTCPServer((self.host, self.port), Handler, bind_and_activate=False)
+        self.server.daemon_threads = True
+        self.server.allow_reuse_address = True
+        self.server.server_bind()
+        self.server.server_activate()
+        return self.server
+
+    def start(self):
+        """Serves in a background thread, returns self so address can be read right away."""
+        self.bind()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread = None
+        if self.server is not None:
+            self.server.server_close()
+            self.server = None
+
+    def duty_cycle(self, now=None):
+        if now is None:
+            now = time.time()
+        return max(0.0, self.duty_cycle_used - (now - self.duty_cycle_updated) * 100.0 / self.duty_cycle_window)
+
+    def h_message(self):
+        return 'H:%s,%s,0113,00000000,1234abcd,%02x,%02x,100101,0001,03,0000' % (
+            CUBE_SERIAL, CUBE_RF_ADDRESS, int(self.duty_cycle()), self.free_mem_slots)
+
+    def m_message(self):
+        m = bytearray([0x56, 0x02, self.rooms])
+        for room_id in range(1, self.rooms + 1):
+            name = ('Room %d' % room_id).encode('utf-8')
+            m += bytes([room_id, len(name)]) + name + rf_address(room_id)
+        m.append(len(self.devices))
+        for device in self.devices:
+            name = device.name.encode('utf-8')
+            m += bytes([device.type]) + device.rf + device.serial.encode('utf-8') + bytes([len(name)]) + name + \
+                bytes([device.room_id])
+        m.append(1)
+        return 'M:00,01,' + base64.b64encode(bytes(m)).decode('utf-8')
+
+    def c_messages(self):
+        lines = []
+        for device in self.devices:
+            config = bytearray(30)
+            # max and min temperature
+            config[20], config[21] = 60, 9
+            lines.append('C:%s,%s' % (device.rf.hex(), base64.b64encode(bytes(config)).decode('utf-8')))
+        return lines
+
+    def l_message(self):
+        data = bytearray()
+        for device in self.devices:
+            if self.change_rate and device.type != MAX_WINDOW_SHUTTER and self.random.random() < self.change_rate:
+                device.actual = max(50, min(300, device.actual + self.random.choice((-1, 1))))
+            data += device.l_submessage()
+        return 'L:' + base64.b64encode(bytes(data)).decode('utf-8')
+
+    def greeting(self):
+        lines = [self.h_message(), self.m_message()] + self.c_messages() + [self.l_message()]
+        return '\r\n'.join(lines) + '\r\n'
+
+    def s_reply(self, command):
+        data = base64.b64decode(command[2:])
+        now = time.time()
+        duty_cycle = self.duty_cycle(now)
+        if duty_cycle + self.command_cost > 100:
+            # budget exhausted, the real Cube refuses to transmit
+            return 'S:%02x,1,%02x' % (int(duty_cycle), self.free_mem_slots)
+        self.duty_cycle_used = duty_cycle + self.command_cost
+        self.duty_cycle_updated = now
+        self.commands += 1
+        device = self.by_rf.get(bytes(data[6:9]))
+        if device is not None and len(data) > 10:
+            targets = [device]
+            if data[1] & 0x04 and data[9]:
+                # group frame, applied by every thermostat of the room
+                targets = [member for member in self.devices
+                           if member.room_id == data[9] and member.type != MAX_WINDOW_SHUTTER]
+            for target in targets:
+                target.target = data[10] & 0x3F
+                target.mode = data[10] >> 6
+        return 'S:%02x,0,%02x' % (int(self.duty_cycle_used), self.free_mem_slots)
+
+    def respond(self, request, response):
+        if self.latency:
+            time.sleep(self.latency)
+        request.sendall((response + '\r\n').encode('utf-8'))
+
+    def dropped(self):
+        return self.drop_rate and self.random.random() < self.drop_rate
+
+    def handle(self, request):
+        with self.lock:
+            self.sessions += 1
+            greeting = self.greeting()
+        if self.latency:
+            time.sleep(self.latency)
+        request.sendall(greeting.encode('utf-8'))
+        buffer = b''
+        while True:
+            try:
+                data = request.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                line = line.decode('utf-8').strip()
+                if line.startswith('q:'):
+                    return
+                if self.dropped():
+                    logger.debug('Dropping session on %s', line[:2])
+                    return
+                with self.lock:
+                    if line.startswith('l:'):
+                        self.polls += 1
+                        response = self.l_message()
+                    elif line.startswith('s:'):
+                        response = self.s_reply(line)
+                    else:
+                        continue
+                self.respond(request, response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=62910)
+    parser.add_argument('--rooms', type=int, default=5)
+    parser.add_argument('--devices-per-room', type=int, default=3)
+    parser.add_argument('--shutters', action='store_true')
+    parser.add_argument('--eco-button', action='store_true')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--drop-rate', type=float, default=0.0)
+    parser.add_argument('--change-rate', type=float, default=0.1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+    simulator = CubeSimulator(args.rooms, args.devices_per_room, args.shutters, args.host, args.port, args.latency,
+                              args.drop_rate, args.change_rate, eco_button=args.eco_button)
+    server = simulator.bind()
+    logger.info('Simulating Max! Cube with %d devices on %s:%s', len(simulator.devices), *simulator.address)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,10 @@ from maxcube.device import MaxDevice
 
 
 class MaxThermostat(MaxDevice):
+    __slots__ = ('mode', 'min_temperature', 'max_temperature', 'actual_temperature', 'target_temperature',
+                 'valve_position')
+    fields = MaxDevice.fields | frozenset(__slots__)
+
     def __init__(self):
         super(MaxThermostat, self).__init__()
         self.mode = None
@@ -0,0 +1,10 @@
+from maxcube.device import MaxDevice
+
+
+class MaxWindowShutter(MaxDevice):
+    __slots__ = ('is_open',)
+    fields = MaxDevice.fields | frozenset(__slots__)
+
+    def __init__(self):
+        super(MaxWindowShutter, self).__init__()
+        self.is_open = None